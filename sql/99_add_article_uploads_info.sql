@@ -0,0 +1,108 @@
+-- Keep the upload information article_view sends to the browser in a
+-- table, one JSONB object per article, maintained by triggers, rather
+-- than aggregating it (and reading length(data)) on every view. The
+-- size is stored on upload, the lower case extension is generated from
+-- the filename. Re-run views.sql afterwards.
+
+BEGIN;
+
+set search_path = uploads, public;
+
+UPDATE upload SET size = length(data) WHERE size IS NULL;
+ALTER TABLE upload ALTER COLUMN size SET NOT NULL;
+
+ALTER TABLE upload
+  ADD COLUMN ext TEXT
+      GENERATED ALWAYS AS (lower(substring(filename, '(\.[^\.]+$)'))) STORED;
+
+CREATE TABLE article_uploads_info
+(
+    article_id INTEGER PRIMARY KEY
+        REFERENCES wiki.article ON DELETE CASCADE,
+    uploads_info JSONB NOT NULL DEFAULT '{}'
+);
+
+-- The keys are read by articles.mjs’ handle_images() and others.
+CREATE OR REPLACE FUNCTION upload_info_json(u upload) RETURNS JSONB AS $$
+    SELECT jsonb_build_object(
+               'id', u.id,
+               'slug', u.slug,
+               'pext', CASE WHEN u.ext = '.png' THEN '.png'
+                            ELSE '.webp'
+                       END,
+               'pv', u.preview_version,
+               'pa', u.preview_avif,
+               'w', u.width,
+               'h', u.height,
+               'size', u.size,
+               'n', u.filename,
+               't', u.title,
+               'dl', u.is_download,
+               'g', u.gallery,
+               'pp', EXISTS (SELECT 1 FROM uploads.preview_job
+                              WHERE preview_job.upload_id = u.id),
+               'd', u.description)
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION update_article_uploads_info() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE uploads.article_uploads_info
+           SET uploads_info = uploads_info - OLD.filename
+         WHERE article_id = OLD.article_id;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO uploads.article_uploads_info (article_id, uploads_info)
+             VALUES (NEW.article_id,
+                     jsonb_build_object(NEW.filename,
+                                        uploads.upload_info_json(NEW)))
+        ON CONFLICT (article_id) DO UPDATE
+                SET uploads_info = article_uploads_info.uploads_info
+                                   || EXCLUDED.uploads_info;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_article_uploads_info
+    AFTER INSERT OR DELETE
+       OR UPDATE OF article_id, filename, title, description, gallery,
+                    is_download, width, height, slug, size,
+                    preview_version, preview_avif
+       ON upload
+    FOR EACH ROW EXECUTE FUNCTION update_article_uploads_info();
+
+-- Queued and finished preview jobs change the upload’s “pp”.
+CREATE OR REPLACE FUNCTION update_article_uploads_info_for_job()
+    RETURNS trigger AS $$
+DECLARE
+    u uploads.upload;
+BEGIN
+    SELECT * INTO u FROM uploads.upload
+     WHERE id = COALESCE(NEW.upload_id, OLD.upload_id);
+
+    -- Not found if the job is deleted along with its upload.
+    IF FOUND THEN
+        UPDATE uploads.article_uploads_info
+           SET uploads_info = uploads_info
+                              || jsonb_build_object(
+                                     u.filename, uploads.upload_info_json(u))
+         WHERE article_id = u.article_id;
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_article_uploads_info_for_job
+    AFTER INSERT OR DELETE ON preview_job
+    FOR EACH ROW EXECUTE FUNCTION update_article_uploads_info_for_job();
+
+INSERT INTO article_uploads_info (article_id, uploads_info)
+     SELECT article_id, jsonb_object_agg(filename, upload_info_json(upload))
+       FROM upload
+      GROUP BY article_id;
+
+COMMIT;
@@ -0,0 +1,20 @@
+-- Indeces matching the orderings of the article list. KeysetPager adds
+-- the primary key to each ORDER BY to make the sort key unique.
+
+BEGIN;
+
+set search_path = wiki, public;
+
+CREATE INDEX IF NOT EXISTS article_mtime_keyset
+    ON article(mtime DESC, id DESC);
+CREATE INDEX IF NOT EXISTS article_ctime_keyset
+    ON article(ctime DESC, id DESC);
+CREATE INDEX IF NOT EXISTS article_wordcount_asc_keyset
+    ON article(wordcount ASC, ctime DESC, id DESC);
+CREATE INDEX IF NOT EXISTS article_wordcount_desc_keyset
+    ON article(wordcount DESC, ctime DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS article_main_title_keyset
+    ON article_title(title, article_id) WHERE is_main_title;
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- Whether AVIF previews were made next to the WebP ones, so the
+-- article view may offer them in a <picture>. Re-run views.sql
+-- afterwards.
+
+BEGIN;
+
+ALTER TABLE uploads.upload
+  ADD COLUMN preview_avif BOOLEAN NOT NULL DEFAULT false;
+
+COMMIT;
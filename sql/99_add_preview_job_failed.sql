@@ -0,0 +1,53 @@
+-- Preview jobs that failed PREVIEW_JOB_MAX_ATTEMPTS times are marked
+-- failed rather than retried. They no longer count as pending, so the
+-- user interface shows the fallback instead of waiting for previews
+-- forever. enqueue_preview_job() clears the mark. Re-run views.sql
+-- afterwards.
+
+BEGIN;
+
+set search_path = uploads, public;
+
+ALTER TABLE preview_job ADD COLUMN failed BOOLEAN NOT NULL DEFAULT false;
+
+-- The worker’s default PREVIEW_JOB_MAX_ATTEMPTS.
+UPDATE preview_job SET failed = true WHERE attempts >= 3;
+
+CREATE OR REPLACE FUNCTION upload_info_json(u upload) RETURNS JSONB AS $$
+    SELECT jsonb_build_object(
+               'id', u.id,
+               'slug', u.slug,
+               'pext', CASE WHEN u.ext = '.png' THEN '.png'
+                            ELSE '.webp'
+                       END,
+               'pv', u.preview_version,
+               'pa', u.preview_avif,
+               'w', u.width,
+               'h', u.height,
+               'size', u.size,
+               'n', u.filename,
+               't', u.title,
+               'dl', u.is_download,
+               'g', u.gallery,
+               'pp', EXISTS (SELECT 1 FROM uploads.preview_job
+                              WHERE preview_job.upload_id = u.id
+                                AND NOT preview_job.failed),
+               'd', u.description)
+$$ LANGUAGE sql STABLE;
+
+DROP TRIGGER update_article_uploads_info_for_job ON preview_job;
+CREATE TRIGGER update_article_uploads_info_for_job
+    AFTER INSERT OR DELETE OR UPDATE OF failed ON preview_job
+    FOR EACH ROW EXECUTE FUNCTION update_article_uploads_info_for_job();
+
+UPDATE article_uploads_info
+   SET uploads_info = info.uploads_info
+  FROM (SELECT article_id,
+               jsonb_object_agg(filename, upload_info_json(upload))
+                   AS uploads_info
+          FROM upload
+         WHERE id IN (SELECT upload_id FROM preview_job WHERE failed)
+         GROUP BY article_id) AS info
+ WHERE article_uploads_info.article_id = info.article_id;
+
+COMMIT;
@@ -0,0 +1,27 @@
+-- Queue of uploads waiting for their previews to be created by
+-- bin/preview_worker. Re-run views.sql afterwards.
+
+BEGIN;
+
+set search_path = uploads, public;
+
+CREATE TABLE preview_job
+(
+    upload_id INTEGER PRIMARY KEY REFERENCES upload ON DELETE CASCADE,
+    ctime TIMESTAMP NOT NULL DEFAULT NOW(),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+
+CREATE OR REPLACE FUNCTION notify_preview_job() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('preview_job', NEW.upload_id::TEXT);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notify_preview_job
+    AFTER INSERT OR UPDATE OF ctime ON preview_job
+    FOR EACH ROW EXECUTE FUNCTION notify_preview_job();
+
+COMMIT;
@@ -0,0 +1,12 @@
+-- Previews are kept in a directory per preview version, so their URLs
+-- never show different images and may be cached forever. Existing
+-- uploads keep their unversioned preview dirs (version 0) until
+-- bin/create_previews --force is run. Re-run views.sql afterwards.
+
+BEGIN;
+
+ALTER TABLE uploads.upload
+  ADD COLUMN preview_version INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE uploads.upload ALTER COLUMN preview_version SET DEFAULT 1;
+
+COMMIT;
@@ -0,0 +1,15 @@
+-- OR together tsqueries like the || operator does, for the prepared
+-- full text search statement, which gets its configurations and search
+-- terms as arrays rather than as one expression per language.
+
+BEGIN;
+
+set search_path = public;
+
+DROP AGGREGATE IF EXISTS tsquery_or_agg(tsquery);
+CREATE AGGREGATE tsquery_or_agg(tsquery) (
+    SFUNC = tsquery_or,
+    STYPE = tsquery
+);
+
+COMMIT;
@@ -0,0 +1,16 @@
+-- Uploads may be kept in the content addressed store configured as
+-- UPLOAD_STORE_PATH (see t4wiki/upload_store.py) instead of the data
+-- column. Re-run views.sql afterwards.
+
+BEGIN;
+
+ALTER TABLE uploads.upload ADD COLUMN sha256 CHAR(64);
+ALTER TABLE uploads.upload ADD COLUMN size BIGINT;
+ALTER TABLE uploads.upload ALTER COLUMN data DROP NOT NULL;
+ALTER TABLE uploads.upload
+  ADD CONSTRAINT upload_data_or_sha256
+      CHECK (data IS NOT NULL OR sha256 IS NOT NULL);
+
+CREATE INDEX upload_sha256 ON uploads.upload(sha256);
+
+COMMIT;
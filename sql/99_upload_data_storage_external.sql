@@ -0,0 +1,12 @@
+-- Keep upload data uncompressed in TOAST, so download_upload.cgi’s
+-- substring() queries read only the chunk requested rather than
+-- decompressing the value from the start. PDFs and images hardly
+-- compress anyway. Affects rows written from now on; existing ones
+-- are converted by rewriting the column, e.g. with
+--   UPDATE uploads.upload SET data = data || ''::BYTEA;
+
+BEGIN;
+
+ALTER TABLE uploads.upload ALTER COLUMN data SET STORAGE EXTERNAL;
+
+COMMIT;
@@ -1,18 +1,22 @@
-set search_path = wiki, public;
+-- Run as a prepared statement (model.included_articles_statement), so
+-- the relations are schema qualified rather than relying on search_path.
+-- “includes” is inlined into both of its references so the root article
+-- id and the recursive join may use the index on article_include’s
+-- article_id instead of resolving every include in the wiki first.
 
-CREATE TEMPORARY VIEW includes AS 
+WITH RECURSIVE includes(includer, included, wants_to_include) AS
+  NOT MATERIALIZED (
     SELECT article_include.article_id AS includer,
            article_title.article_id AS included,
            wants_to_include
-      FROM article_include
-      LEFT JOIN article_title
+      FROM wiki.article_include
+      LEFT JOIN wiki.article_title
         ON wants_to_include = (CASE WHEN namespace IS NULL THEN title
                                     WHEN namespace IS NOT NULL
                                         THEN title || ' (' || namespace || ')'
                                 END)
-     WHERE article_title.article_id IS NOT NULL;
-     
-WITH RECURSIVE rincludes(includer, included, wants_to_include) AS (
+     WHERE article_title.article_id IS NOT NULL
+), rincludes(includer, included, wants_to_include) AS (
     SELECT includer, included, wants_to_include
       FROM includes
      WHERE includer = %s -- root article id
@@ -24,6 +28,4 @@ WITH RECURSIVE rincludes(includer, included, wants_to_include) AS (
 SELECT included AS article_id,
        wants_to_include AS included_as
   FROM rincludes
-  LEFT JOIN article_info ON included = article_info.id
   GROUP BY included, included_as;
-
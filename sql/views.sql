@@ -123,36 +123,23 @@ set search_path = uploads, public;
 DROP VIEW IF EXISTS upload_info CASCADE;
 CREATE VIEW upload_info AS
    SELECT id, article_id, filename, title, description, gallery,
-          is_download, sortrank, width, height, ctime, slug,
-          substring(filename, '(\.[^\.]+$)') AS ext,
-          CASE WHEN  substring(filename, '(\.[^\.]+$)') = '.png' THEN '.png'
+          is_download, sortrank, width, height, ctime, slug, sha256,
+          preview_version, preview_avif, ext,
+          CASE WHEN ext = '.png' THEN '.png'
                ELSE '.webp'
           END AS preview_ext,
-          length(data) AS size
+          size,
+          EXISTS (SELECT 1 FROM preview_job
+                   WHERE preview_job.upload_id = upload.id
+                     AND NOT preview_job.failed)
+              AS preview_pending
      FROM upload;
 
+-- Maintained by triggers, see 99_add_article_uploads_info.sql.
 DROP VIEW IF EXISTS upload_info_for_view CASCADE;
 CREATE VIEW upload_info_for_view AS
-WITH
-upload_info_by_filename AS (
-    SELECT article_id,
-           filename,
-           jsonb_build_object('id', id,
-                              'slug', slug,
-                              'pext', preview_ext,
-                              'w', width,
-                              'h', height,
-                              'size', size,
-                              'n', filename,
-                              't', title,
-                              'dl', is_download,
-                              'g', gallery, 
-                              'd', description) AS upload_info
-      FROM upload_info
-)
-SELECT article_id, json_object_agg(filename, upload_info) AS uploads_info
-  FROM upload_info_by_filename
- GROUP BY article_id;
+SELECT article_id, uploads_info
+  FROM article_uploads_info;
 
 
 COMMIT;
@@ -1,6 +1,6 @@
 import os.path as op, re, string, datetime, io, json, time, tomllib, pathlib
 import sys, subprocess, urllib.parse, mimetypes, unicodedata, traceback
-from PIL import Image
+import collections, concurrent.futures
 
 from flask import (current_app as app, url_for, send_file,
                    g, request, session, abort, redirect, make_response)
@@ -27,15 +27,20 @@ from tinymarkup.utils import html_start_tag
 from .ptutils import test
 from .utils import (gets_parameters_from_request, get_site_url, rget,
                     get_languages, get_article_root_languages)
-from .filterform import (AndreasPager, AndreasPagerOption, FilterFormHandler,
-                         OrderByHandler)
+from .filterform import (AndreasPagerOption, FilterFormHandler,
+                         OrderByHandler, KeysetPager)
 from .form_feedback import FormFeedback, NullFeedback
 from . import model
-from .db import insert_from_dict, commit, query_one, execute, cursor
+from .upload_store import get_upload_store
+from .previews import (create_previews_for, enqueue_preview_job,
+                       ensure_previews_for, preview_paths_for)
+from .db import (insert_from_dict, copy_from_dict, commit, query_one,
+                 execute, cursor, read_only)
 from .markup import (Title, tools_by_format, compile_article,
                      update_titles_for, update_links_for, update_includes_for,
                      normalize_source, )
 from .authentication import login_required, role_required
+from .exceptions import FilenameUnavailable
 from . import html_markup
 
 bp = Blueprint("articles", __name__, url_prefix="/articles")
@@ -433,78 +438,6 @@ def user_info_form(id:int, user_info_source=None):
     return template(linkman=LinkMan('user_info', article), feedback=feedback)
 
 
-def make_grey_image(greypath):
-    img = Image.new(mode="L", size=(200,200), color=128)
-    img.save(greypath)
-
-def create_previews_for(upload:model.Upload):
-    preview_dir = pathlib.Path(app.config["PREVIEW_PATH"],
-                               upload.preview_dir_name)
-    if not preview_dir.exists():
-        # Create the preview dir.
-        preview_dir.mkdir()
-    else:
-        # Clear the preview dir.
-        for pp in preview_dir.glob("*"):
-            pp.unlink()
-
-    if upload.ext in { ".jpg", ".png", ".pdf", ".webp" }:
-        create_image_previews_for(preview_dir, upload)
-    else:
-        # Create default grey images.
-        greypath = pathlib.Path(preview_dir, "grey.jpg")
-        make_grey_image(greypath)
-        for size in model.Upload.preview_sizes:
-            outfilepath = pathlib.Path(preview_dir,
-                                       "preview%i.jpg" % (size))
-            outfilepath.hardlink_to(greypath)
-
-
-def create_image_previews_for(preview_dir, upload):
-    original_path = pathlib.Path(preview_dir, "original" + upload.ext)
-    with original_path.open("wb") as fp:
-        fp.write(upload.data)
-
-    if upload.ext != ".pdf":
-        pil_image = Image.open(original_path)
-        width, height = pil_image.size
-        upload.update_db( width=width, height=height )
-    else:
-        width, height = 1000000, 1000000
-
-    for size in model.Upload.preview_sizes:
-        ext = upload.ext
-
-        if ext in (".pdf", ".jpg",):
-            ext = ".webp"
-
-        outfilepath = pathlib.Path(preview_dir,
-                                   "preview%i%s" % (size, ext))
-
-        if width < size and height < size:
-            # No point in making this preview.
-            outfilepath.hardlink_to(original_path)
-        else:
-            cmd = [ "convert",
-                    str(original_path) + "[0]",
-                    "-thumbnail",
-                    "%ix%i" % ( size, size, ),
-                    str(outfilepath) ]
-
-            done = subprocess.run(cmd)
-
-            if done.returncode != 0:
-                make_grey_image(outfilepath)
-
-    original_path.unlink()
-
-def create_previews_for_all():
-    for upload in model.Upload.select():
-        create_previews_for(upload)
-
-    # To store image dimensions:
-    commit()
-
 separator_re = re.compile(r"[/\\:]")
 def sanitize_filename(filename):
     filename = filename.replace("..", "_") # For security.
@@ -514,6 +447,12 @@ def sanitize_filename(filename):
 
     return filename
 
+def stream_size(stream):
+    stream.seek(0, io.SEEK_END)
+    ret = stream.tell()
+    stream.seek(0)
+    return ret
+
 @bp.route("/files_form.cgi", methods=("GET", "POST"))
 @role_required("Writer")
 @gets_parameters_from_request
@@ -524,6 +463,17 @@ def files_form(id:int):
     errors = xsc.Frag()
 
     if request.method == "POST":
+        # Werkzeug spools large files to disk while it parses the
+        # request, so they are never in memory as a whole. Reject
+        # requests that are too large before it does.
+        max_request_size = app.config.get("UPLOAD_MAX_REQUEST_SIZE")
+        if max_request_size and \
+           ( request.content_length or 0 ) > max_request_size:
+            abort(413)
+
+        max_file_size = app.config.get("UPLOAD_MAX_FILE_SIZE")
+
+        uploads, files, filenames = [], [], set()
         for file in request.files.getlist("files"):
             # When there is no file, the Browser sends am empty one.
             if file.filename != "":
@@ -532,25 +482,58 @@ def files_form(id:int):
                 name, ext = op.splitext(filename)
                 ext = ext.lower()
 
+                size = stream_size(file.stream)
+                if max_file_size and size > max_file_size:
+                    errors.append(f"“{filename}” is larger than "
+                                  f"{max_file_size} bytes.")
+                    continue
+
                 count, = query_one("SELECT COUNT(*) FROM uploads.upload "
                                    " WHERE article_id = %s "
                                    "   AND filename = %s", (id, filename,))
-                if count > 0:
+                if count > 0 or filename in filenames:
                     errors.append(f"A file named “{filename}” already exists "
                                   f"for this article.")
                 else:
-                    upload = { "article_id": id,
-                               "filename": filename,
-                               "data": file.read(),
-                               "slug": slug(20),
-                               "is_download": ext == ".pdf"
-                              }
-                    upload_id = insert_from_dict("uploads.upload", upload)
+                    filenames.add(filename)
+                    uploads.append({ "article_id": id,
+                                     "filename": filename,
+                                     "slug": slug(20),
+                                     "is_download": ext == ".pdf",
+                                     "preview_version": 1,
+                                     "size": size, })
+                    files.append(file)
+
+        store = get_upload_store()
+        if store is None:
+            # COPY the files into uploads.upload.data chunk by chunk.
+            for upload, file in zip(uploads, files):
+                upload["id"], = query_one(
+                    "SELECT nextval(pg_get_serial_sequence("
+                    "    'uploads.upload', 'id'))")
+                copy_from_dict("uploads.upload", upload, "data", file.stream)
+        else:
+            # Hash and write the files in parallel.
+            with concurrent.futures.ThreadPoolExecutor(
+                    app.config.get("UPLOAD_CONCURRENCY", 4)) as executor:
+                for upload, stored in zip(uploads, executor.map(
+                        lambda file: store.put_file(file.stream), files)):
+                    upload["sha256"], upload["size"] = stored
 
-                    upload["id"] = upload_id
-                    upload = model.Upload.from_dict(upload)
+            for upload in uploads:
+                upload["id"] = insert_from_dict("uploads.upload", upload)
 
-                    create_previews_for(upload)
+        # The previews are created from what has been committed.
+        commit()
+
+        for upload in uploads:
+            if app.config.get("PREVIEW_QUEUE", False):
+                enqueue_preview_job(upload["id"])
+            elif app.config.get("PREVIEW_LAZY", False):
+                # The preview route creates them when requested.
+                pass
+            else:
+                create_previews_for(model.Upload.from_dict(upload))
 
         commit()
 
@@ -569,37 +552,135 @@ def delete(id:int):
     commit()
     return redirect(get_site_url())
 
+def upload_field_value(name, value):
+    if name == "sortrank":
+        return float(value)
+    elif name in { "gallery", "is_download" }:
+        return value is True or value == "on"
+    elif name in { "title", "description", }:
+        return str(value)
+    elif name == "filename":
+        return sanitize_filename(str(value))
+    else:
+        raise ValueError("Can’t modify upload field " + repr(name))
+
+def modify_uploads_in_db(article_id, changes, order=None):
+    """
+    Apply “changes”, a sequence of ( upload_id, field name, value, )
+    tuples, to the uploads of article “article_id” with one UPDATE
+    statement. If “order”, a list of upload ids, is given, number the
+    uploads’ sortranks in that order, with another one. Raise
+    ValueError or TypeError if a change or the order is malformed and
+    FilenameUnavailable if a new filename is used by another upload in
+    the article, even if that one is renamed, too. Does not commit.
+    """
+    if order is not None:
+        if type(order) not in ( list, tuple, ):
+            raise TypeError("Malformed order " + repr(order))
+        order = [ int(upload_id) for upload_id in order ]
+        if len(set(order)) != len(order):
+            raise ValueError("Upload listed twice in order " + repr(order))
+
+    rows = {}
+    for change in changes:
+        if type(change) not in ( list, tuple, ) or len(change) != 3:
+            raise ValueError("Malformed change " + repr(change))
+        upload_id, name, value = change
+        upload_id = int(upload_id)
+        row = rows.setdefault(upload_id, { "id": upload_id, })
+        row[name] = upload_field_value(name, value)
+
+    renamed = { row["id"]: row["filename"]
+                for row in rows.values() if "filename" in row }
+    if renamed:
+        # Verify no other upload (in this article_id) has that filename
+        # now or gets it with these changes. UNIQUE(article_id, filename)
+        # is checked row by row during the UPDATE, so swapping two
+        # filenames would fail there.
+        owners = { filename: id
+                   for id, filename in execute("SELECT id, filename "
+                                               "  FROM uploads.upload "
+                                               " WHERE article_id = %s",
+                                               ( article_id, )).fetchall() }
+        counts = collections.Counter(renamed.values())
+        taken = sorted({ filename for id, filename in renamed.items()
+                         if counts[filename] > 1
+                         or owners.get(filename, id) != id })
+        if taken:
+            raise FilenameUnavailable(
+                "A file named “%s” already exists." % "”, “".join(taken),
+                taken)
+
+    if rows:
+        # Fields not mentioned for an upload are NULL in the recordset
+        # and keep their value. None of them may be NULL.
+        execute("UPDATE uploads.upload "
+                "   SET title = COALESCE(changes.title, upload.title), "
+                "       description = COALESCE(changes.description, "
+                "                              upload.description), "
+                "       filename = COALESCE(changes.filename, "
+                "                           upload.filename), "
+                "       is_download = COALESCE(changes.is_download, "
+                "                              upload.is_download), "
+                "       gallery = COALESCE(changes.gallery, upload.gallery), "
+                "       sortrank = COALESCE(changes.sortrank, upload.sortrank) "
+                "  FROM jsonb_to_recordset(%s::JSONB) "
+                "           AS changes(id INTEGER, title TEXT, "
+                "                      description TEXT, filename TEXT, "
+                "                      is_download BOOLEAN, gallery BOOLEAN, "
+                "                      sortrank FLOAT) "
+                " WHERE upload.id = changes.id "
+                "   AND upload.article_id = %s",
+                ( json.dumps(list(rows.values())), article_id, ))
+
+    if order:
+        execute("UPDATE uploads.upload "
+                "   SET sortrank = ordered.rank "
+                "  FROM unnest(%s::INTEGER[]) WITH ORDINALITY "
+                "           AS ordered(id, rank) "
+                " WHERE upload.id = ordered.id "
+                "   AND upload.article_id = %s",
+                ( order, article_id, ))
+
+@bp.route("/modify_uploads.cgi", methods=("POST",))
+@role_required("Writer")
+def modify_uploads():
+    """
+    Apply a batch of changes to an article’s uploads in one
+    transaction. Expects a JSON object like
+    { "article_id": 1,
+      "changes": [ [ upload_id, field name, value ], … ],
+      "order": [ upload_id, … ] }
+    in the request’s body. “order” is optional.
+    """
+    data = request.get_json(force=True, silent=True)
+    if type(data) is not dict:
+        return make_response("Malformed request.", 400)
+
+    try:
+        modify_uploads_in_db(int(data["article_id"]),
+                             data.get("changes", []),
+                             data.get("order"))
+    except FilenameUnavailable as exc:
+        return make_response(str(exc), 409) # 409 => “Conflict”
+    except (KeyError, TypeError, ValueError) as exc:
+        return make_response("Malformed request: " + str(exc), 400)
+
+    commit()
+
+    return make_response("Ok", 200)
+
 @bp.route("/modify_upload.cgi", methods=("POST",))
 @role_required("Writer")
 @gets_parameters_from_request
 def modify_upload(article_id:int, upload_id:int, name, value):
-    assert name in { "title", "description", "filename", "is_download",
-                     "gallery", "sortrank" }, ValueError
+    try:
+        modify_uploads_in_db(article_id, [ ( upload_id, name, value, ), ])
+    except FilenameUnavailable as exc:
+        return make_response(str(exc), 409) # 409 => “Conflict”
+    except ValueError as exc:
+        return make_response(str(exc), 400)
 
-    if name == "sortrank":
-        value = float(value)
-    elif name in { "gallery", "is_download" }:
-        value = bool(value == "on")
-    elif name == "filename":
-        value = sanitize_filename(value)
-
-        # Verify no other upload (in this article_id) has that filename.
-        count, = query_one(sql.select(
-            ("COUNT(*)",),
-            ("uploads.upload",),
-            sql.where("article_id = %i " % article_id,
-                      "AND id <> %i " % upload_id,
-                      "AND filename =", sql.string_literal(value))))
-        if count > 0:
-            return make_response(f"A file named “{value}” already exists.",
-                                 409) # 409 => “Conflict”
-
-    data = { name: value }
-    command = sql.update(model.Upload.__relation__,
-                         sql.where("article_id = %i" % article_id,
-                                   " AND id = %i" % upload_id),
-                         data)
-    execute(command)
     commit()
 
     return make_response("Ok", 200)
@@ -619,43 +700,154 @@ def delete_upload(article_id:int, upload_id:int):
 @role_required("Writer")
 @gets_parameters_from_request
 def update_sortranks(article_id:int):
-    with cursor() as cc:
-        cc.execute("SELECT id FROM uploads.upload "
-                   " WHERE article_id = %s "
-                   " ORDER BY sortrank", (article_id,))
-
-        for idx, (id,) in enumerate(cc.fetchall()):
-            cc.execute("UPDATE uploads.upload "
-                       "   SET sortrank = %s::FLOAT "
-                       " WHERE id = %s" % ( idx+1, id, ))
+    execute("UPDATE uploads.upload "
+            "   SET sortrank = ranked.rank "
+            "  FROM (SELECT id, row_number() OVER (ORDER BY sortrank, id) "
+            "                   AS rank "
+            "          FROM uploads.upload "
+            "         WHERE article_id = %s) AS ranked "
+            " WHERE upload.id = ranked.id", ( article_id, ))
     commit()
 
     return redirect(url_for("articles.files_form") + "?id=%i" % article_id)
 
 
+def content_disposition(filename):
+    """
+    Return keyword arguments for Headers.set("Content-Disposition", …)
+    the way send_file() does it.
+    """
+    try:
+        filename.encode("ascii")
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename)
+        simple = simple.encode("ascii", "ignore").decode("ascii")
+        return { "filename": simple,
+                 "filename*": "UTF-8''%s" % urllib.parse.quote(filename), }
+    else:
+        return { "filename": filename, }
+
 @bp.route("/download_upload.cgi")
 @role_required("Writer")
 @gets_parameters_from_request
 def download_upload(id:int):
-    with cursor() as cc:
-        cc.execute("SELECT filename, data FROM uploads.upload "
-                   " WHERE id = %s ", (id,))
-
-        filename, data = cc.fetchone()
+    """
+    Send an upload from the upload store or stream it from the
+    database in chunks, supporting conditional and Range requests.
+    Uploads never change once stored, so slug and size make a strong
+    ETag.
+    """
+    upload = model.Upload.select_by_primary_key(id)
+    if upload is None:
+        abort(404)
 
-    response = make_response(bytes(data), 200)
-    mimetype, subtype = mimetypes.guess_type(filename)
+    mimetype, encoding = mimetypes.guess_type(upload.filename)
     if not mimetype:
         mimetype = "application/octet-stream"
 
-    return send_file(io.BytesIO(bytes(data)),
-                     download_name = filename,
-                     as_attachment = True,
-                     mimetype=mimetype)
+    store = get_upload_store()
+    if store is not None and upload.sha256:
+        # send_file() takes care of conditional and Range requests and
+        # hands the file to the web server if USE_X_SENDFILE is set.
+        return send_file(store.path_for(upload.sha256),
+                         mimetype=mimetype,
+                         as_attachment=True,
+                         download_name=upload.filename,
+                         conditional=True,
+                         etag=upload.sha256)
+
+    etag = "%s-%i" % ( upload.slug.strip(), upload.size, )
+
+    response = app.response_class(mimetype=mimetype)
+    response.headers.set("Content-Disposition", "attachment",
+                         **content_disposition(upload.filename))
+    response.headers["Accept-Ranges"] = "bytes"
+    response.set_etag(etag)
+    response.last_modified = upload.ctime
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    start, length = 0, upload.size
+
+    byte_range = request.range
+    if byte_range is not None:
+        if_range = request.if_range
+        if if_range.etag is not None:
+            applies = ( if_range.etag == etag )
+        elif if_range.date is not None:
+            applies = ( if_range.date >= response.last_modified )
+        else:
+            applies = True
+
+        if applies:
+            span = byte_range.range_for_length(upload.size)
+            if span is not None:
+                start, stop = span
+                length = stop - start
+                response.status_code = 206
+                response.headers["Content-Range"] = "bytes %i-%i/%i" % (
+                    start, stop - 1, upload.size, )
+            elif len(byte_range.ranges) == 1:
+                response.status_code = 416
+                response.headers["Content-Range"] = "bytes */%i" % (
+                    upload.size, )
+                return response
+            # Several ranges at once are answered with the whole file.
+
+    response.response = upload.iter_data(start, length)
+    response.content_length = length
+
+    return response
 
 emerson_sermon_title_re = re.compile(r"Sermon ([CLXVI]+)")
 
+preview_dir_name_re = re.compile(r"^\d+_(\d+)_")
+preview_version_re = re.compile(r"_v\d+$")
+preview_filename_re = re.compile(r"^preview\d+\.[a-z]+$")
+
+@role_required("Reader")
+def preview(preview_dir_name, filename):
+    """
+    Send a preview image from PREVIEW_PATH, creating the upload’s
+    previews first if they do not exist (yet). The web server should
+    serve /previews/ from PREVIEW_PATH itself and pass requests for
+    missing files on to us. Versioned previews never change, so
+    caches may keep them forever.
+    """
+    match = preview_dir_name_re.match(preview_dir_name)
+    if match is None or preview_filename_re.match(filename) is None:
+        abort(404)
+
+    preview_dir = pathlib.Path(app.config["PREVIEW_PATH"], preview_dir_name)
+    path = pathlib.Path(preview_dir, filename)
+
+    if not path.exists():
+        upload = model.Upload.select_by_primary_key(int(match.group(1)))
+        if upload is None \
+           or upload.preview_dir_name != preview_dir_name \
+           or path not in preview_paths_for(preview_dir, upload):
+            abort(404)
+
+        if ensure_previews_for(upload):
+            # Store the dimensions.
+            commit()
+
+    response = send_file(path, conditional=True)
+    if preview_version_re.search(preview_dir_name) is not None:
+        response.headers["Cache-Control"] = \
+            "public, max-age=31536000, immutable"
+    return response
+
+@bp.record_once
+def register_preview_route(state):
+    # Previews are at /previews/ rather than below /articles/, where
+    # the web server finds them in PREVIEW_PATH.
+    state.app.add_url_rule("/previews/<preview_dir_name>/<filename>",
+                           "preview", preview)
+
 @bp.route("/all.cgi", methods=("GET", "POST"))
+@read_only
 @role_required("Writer")
 @gets_parameters_from_request
 def all():
@@ -669,7 +861,8 @@ def all():
             return None
 
     def format_title_label(article):
-        title = article.main_title
+        # Articles without a main title come last.
+        title = article.main_title or "–"
         match = emerson_sermon_title_re.match(title)
         if match is None:
             return title[:5]
@@ -681,25 +874,22 @@ def all():
         AndreasPagerOption(
             "main_title", "Title",
             pager_button_label_f=format_title_label,
-            select_expressions=("main_title",)
         ),
         AndreasPagerOption(
             "mtime DESC", "Modification Time",
-            pager_button_label_f=None, midlinknum=10, 
+            pager_button_label_f=None,
         ),
         AndreasPagerOption(
             "ctime DESC", "Creation Time",
-            pager_button_label_f=None, midlinknum=10, 
+            pager_button_label_f=None,
         ),
         AndreasPagerOption(
             "wordcount ASC, ctime DESC", "Shortness",
             pager_button_label_f=lambda a: str(a.wordcount),
-            select_expressions=("wordcount",)
         ),
         AndreasPagerOption(
             "wordcount DESC, ctime DESC", "Lengthyness",
             pager_button_label_f=lambda a: str(a.wordcount),
-            select_expressions=("wordcount",)
         ),
     ]
     
@@ -718,17 +908,14 @@ def all():
     else:
         where = sql.where("namespace = ", sql.string_literal(filter.namespace))
 
-    count = model.ArticleForList.count(where)
     pagesize = 30
 
-    print("pagesize =", repr(pagesize))
-
-    pagination = AndreasPager(pagesize, count,
-                              orderby, model.ArticleForList,
-                              where, orderby.sql_clause(), None)
-    #pagination = PaginationHandler(pagesize=pagesize, count=count)
-    articles = model.ArticleForList.select(
-        where, orderby.sql_clause(), *pagination.sql_clauses())
+    # Keyset pagination, so deep pages cost as much as the first one.
+    # The orderings with a pager_button_label_f show the range of the
+    # current page, taken from its first and last article.
+    pagination = KeysetPager(pagesize, orderby, model.ArticleForList, where,
+                             nullable=("main_title",))
+    articles = pagination.select()
 
     if orderby.active.id == "ctime":
         title = "Recently Created"
@@ -758,7 +945,8 @@ def disable_triggers():
 def redo_html():
     disable_triggers()
     
-    for article in model.ArticleForRedo.select(sql.orderby("full_title")):
+    articles = model.ArticleForRedo.select_streaming(sql.orderby("full_title"))
+    for article in articles:
         print(article.full_title, end="")
         sys.stdout.flush()
 
@@ -798,7 +986,7 @@ def redo_html():
 def redo_bibtex():
     disable_triggers()
     
-    articles = model.ArticleForBibTeXRedo.select(
+    articles = model.ArticleForBibTeXRedo.select_streaming(
         sql.where("bibtex_source IS NOT NULL"), sql.orderby("full_title"))
 
     for article in articles:
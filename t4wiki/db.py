@@ -4,9 +4,11 @@
 Generic utility classes and routines for working with the PostgreSQL backend.
 """
 
-import sys, os.path as op, pathlib
-import psycopg2, datetime, types
-from flask import g, current_app as app, request
+import sys, os.path as op, pathlib, itertools, re, time, weakref, threading
+import concurrent.futures, functools, logging, contextlib, select, socket
+import psycopg2, psycopg2.extensions, datetime, types
+from flask import (g, current_app as app, request, session,
+                   has_request_context)
 
 from termcolor import colored
 
@@ -17,32 +19,129 @@ from t4 import sql
 from t4.typography import pretty_german_date
 
 from .utils import rget
+from .dbpool import ConnectionPool, PoolExhausted
+from .profiler import ProfilingCursorWrapper
+
+logger = logging.getLogger(__name__)
 
 class DbException(Exception): pass
 class DbUsageException(Exception): pass
 
+class QueryTimeout(DbException):
+    """
+    Raised by expensive_query() if the statement timeout was reached
+    or too many expensive queries are running already.
+    """
+
+class ClientDisconnected(DbException):
+    """
+    Raised by expensive_query() if the query was cancelled because the
+    client closed its connection.
+    """
+
+# Names for server-side cursors need to be unique per connection.
+_cursor_counter = itertools.count()
+
 sql_backend = sql.Backend(psycopg2, None)
 def rollup_sql(*query):
     #debsql, params, = sql.rollup(sql_backend, *query, debug=True)
     return sql.rollup(sql_backend, *query)
 
+def get_pool():
+    return app.dbpool
+
+def get_replica_pool():
+    """
+    Return the pool of connections to the read-only standby, if
+    REPLICA_DATASOURCE is configured, it is not known to be down and
+    the user has not written to the primary within the last
+    REPLICA_READ_YOUR_WRITES seconds. Return None otherwise.
+
+    Include a “connect_timeout” in REPLICA_DATASOURCE, so a standby
+    that does not answer is given up on quickly.
+    """
+    pool = getattr(app, "replica_pool", None)
+    if pool is None:
+        return None
+
+    if app.replica_down_until > time.monotonic():
+        return None
+
+    if has_request_context() and \
+       session.get("db_primary_until", 0) > time.time():
+        return None
+
+    return pool
+
+def _replica_failed(exc):
+    retry = app.config.get("REPLICA_RETRY_INTERVAL", 30.0)
+    logger.warning("Read replica unavailable (%s), using the primary "
+                   "for the next %.0f seconds.", exc, retry)
+    app.replica_down_until = time.monotonic() + retry
+
+def read_only(func):
+    """
+    Decorator for views that never write to the database. Their
+    connection is taken from the replica pool if there is one. Place it
+    right below @route(), so it takes effect before the authentication
+    decorators query the database.
+    """
+    @functools.wraps(func)
+    def wrapped_func(*args, **kwargs):
+        g.db_read_only = True
+        return func(*args, **kwargs)
+
+    return wrapped_func
+
 def get_dbconn():
-    #if "dbconn" not in g:
-    #    g.dbconn = psycopg2.connect(**app.config["DATASOURCE"])
+    """
+    Return the database connection for the current request, checking
+    one out of the pool on first use. Views marked @read_only get a
+    connection to the replica, if available. Deployments that put their
+    own connection into g.dbconn keep using that.
+    """
+    if "dbconn" not in g:
+        pool, dbconn = None, None
+
+        if getattr(g, "db_read_only", False):
+            pool = get_replica_pool()
+            if pool is not None:
+                try:
+                    dbconn = pool.getconn(
+                        timeout=app.config.get("REPLICA_TIMEOUT", 1.0))
+                except (psycopg2.Error, PoolExhausted) as exc:
+                    _replica_failed(exc)
+
+        if dbconn is None:
+            pool = get_pool()
+            dbconn = pool.getconn()
+
+        g.dbconn = dbconn
+        g.dbpool = pool
     return g.dbconn
 
-# def close_dbconn(e=None):
-#     dbconn = g.pop("dbconn", None)
-#     if dbconn is not None:
-#         dbconn.rollback()
-#         dbconn.close()
-
-# def init_app(app):
-#     app.teardown_appcontext(close_dbconn)
+def close_dbconn(e=None):
+    # Only return connections we got from the pool ourselves.
+    pool = g.pop("dbpool", None)
+    dbconn = g.pop("dbconn", None)
+    if pool is not None and dbconn is not None:
+        # putconn() rolls back whatever has not been committed.
+        pool.putconn(dbconn)
+
+def init_app(app):
+    if getattr(app, "dbpool", None) is None:
+        app.dbpool = ConnectionPool.from_config(app.config)
+
+        # The replica pool does not connect up front, so an unavailable
+        # standby will not keep the application from starting.
+        if app.config.get("REPLICA_DATASOURCE"):
+            app.replica_pool = ConnectionPool.from_config(
+                app.config, "REPLICA_DATASOURCE", minconn=0)
+        else:
+            app.replica_pool = None
+        app.replica_down_until = 0.0
 
-#     @app.teardown_request
-#     def teardown_request(exception):
-#         rollback()
+        app.teardown_appcontext(close_dbconn)
 
 class CursorDebugWrapper(object):
     def __init__(self, cursor):
@@ -51,6 +150,12 @@ class CursorDebugWrapper(object):
     def __getattr__(self, name):
         return getattr(self._cursor, name)
 
+    def __setattr__(self, name, value):
+        if name == "_cursor":
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
     def execute(self, query, vars=None):
         sql = self._cursor.mogrify(query, vars)
         print(colored(sql.decode("utf-8", errors="replace"), "cyan"))
@@ -65,43 +170,198 @@ class CursorDebugWrapper(object):
     def __iter__(self):
         return self._cursor.__iter__()
 
-def cursor():
-    cursor = get_dbconn().cursor()
+def cursor(name=None):
+    """
+    Return a cursor on the current connection. Passing a “name” will
+    create a server-side cursor which fetches its rows in batches of
+    cursor.itersize.
+    """
+    return wrap_cursor(get_dbconn().cursor(name=name))
+
+def wrap_cursor(cursor, debug_sql=None, profile=None):
+    """
+    Wrap “cursor” for debugging and profiling as configured. Outside
+    the request’s thread pass “debug_sql” and “profile” explicitly.
+    """
+    if debug_sql is None:
+        debug_sql = app.debug_sql
+        if app.profile_sql:
+            profile = g.get("sql_profile", None)
+
+    if debug_sql:
+        cursor = CursorDebugWrapper(cursor)
+
+    if profile is not None:
+        cursor = ProfilingCursorWrapper(cursor, profile)
+
+    return cursor
+
+def sql_literal(value):
+    """
+    Return “value” quoted by psycopg2 as a string that may be used
+    within the raw strings of a t4.sql tree.
+    """
+    with cursor() as cc:
+        literal = cc.mogrify("%s", (value,))
 
-    if app.debug_sql:
-        return CursorDebugWrapper(cursor)
-    else:
-        return cursor
+    # The rolled up command will be formatted by psycopg2 again.
+    return literal.decode("utf-8").replace("%", "%%")
 
 def commit():
     get_dbconn().commit()
 
+    # Have this user’s read-only views use the primary for a while, so
+    # they do not miss what was just written while the replica catches
+    # up.
+    if has_request_context() and \
+       getattr(app, "replica_pool", None) is not None:
+        session["db_primary_until"] = time.time() + app.config.get(
+            "REPLICA_READ_YOUR_WRITES", 10.0)
+
 def rollback():
     get_dbconn().rollback()
 
 def insert_from_dict(relation, d, retrieve_id=True, sequence_name=None):
+    """
+    Insert one row and return its new id, unless “d” provides one or
+    retrieve_id is False. The id is retrieved using RETURNING in the same
+    round trip. Passing a “sequence_name” will query CURRVAL() from that
+    sequence instead, for tables whose primary key is not called “id”.
+    """
     if sequence_name is not None:
-        retrieve_id = True
+        command = sql.insert(relation, list(d.keys()), [ d, ])
+
+        with cursor() as cc:
+            command, params = rollup_sql(command)
+            cc.execute(command, params)
+            cc.execute("SELECT CURRVAL('%s')" % sequence_name)
+            id, = cc.fetchone()
+            return id
 
-    command = sql.insert(relation, list(d.keys()), [ d, ])
+    if not "id" in d and retrieve_id:
+        id, = insert_many(relation, [ d, ], returning="id")
+        return id
+    else:
+        insert_many(relation, [ d, ])
+        return None
+
+def insert_many(relation, rows, returning=None, on_conflict=None,
+                pagesize=1000):
+    """
+    Insert “rows”, a sequence of dicts with identical keys, using one
+    multi-row INSERT statement per “pagesize” rows.
+
+    • “on_conflict”: Appended to the statement as ON CONFLICT clause,
+      e.g. "(article_id, target_title) DO NOTHING" or
+      "(article_id, filename) DO UPDATE SET title = EXCLUDED.title"
+      to upsert.
+    • “returning”: A column name or a tuple of them. If provided, return
+      a list with one value (or tuple, respectively) per row inserted,
+      in the order of “rows”. Rows skipped by ON CONFLICT DO NOTHING
+      are not returned.
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+
+    columns = list(rows[0].keys())
+    for row in rows:
+        if len(row) != len(columns) or any(c not in row for c in columns):
+            raise DbUsageException(
+                "All rows passed to insert_many() must have the same keys.")
 
+    if isinstance(returning, str):
+        returning_columns = ( returning, )
+    else:
+        returning_columns = returning
+
+    ret = []
     with cursor() as cc:
-        command, params = rollup_sql(command)
-        cc.execute(command, params)
+        for start in range(0, len(rows), pagesize):
+            command = sql.insert(relation, columns,
+                                 rows[start:start+pagesize])
+            command, params = rollup_sql(command)
+
+            if on_conflict:
+                command += " ON CONFLICT " + on_conflict
+
+            if returning_columns:
+                command += " RETURNING " + ", ".join(returning_columns)
 
-        if not "id" in d and retrieve_id:
-            if sequence_name is None:
-                if isinstance(relation, sql.relation):
-                    name = relation.name.name
+            cc.execute(command, params)
+
+            if returning_columns:
+                if isinstance(returning, str):
+                    ret.extend([ tpl[0] for tpl in cc.fetchall() ])
                 else:
-                    name = str(relation)
-                sequence_name = '%s_id_seq' % name
+                    ret.extend(cc.fetchall())
 
-            cc.execute("SELECT CURRVAL('%s')" % sequence_name)
-            id, = cc.fetchone()
-            return id
-        else:
-            return None
+    if returning_columns:
+        return ret
+    else:
+        return None
+
+copy_escapes = { "\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r", }
+copy_escape_re = re.compile(r"[\\\t\n\r]")
+def copy_text(value):
+    """
+    Return “value” in COPY’s text format.
+    """
+    if value is None:
+        return "\\N"
+    elif isinstance(value, bool):
+        return "t" if value else "f"
+    else:
+        return copy_escape_re.sub(lambda match: copy_escapes[match.group()],
+                                  str(value))
+
+class CopyReader(object):
+    """
+    A file-like object for cursor.copy_expert() that returns the
+    bytes yielded by “chunks”.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+
+        if size < 0:
+            size = len(self._buffer)
+
+        ret = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return ret
+
+def copy_from_dict(relation, d, file_column, fp, chunk_size=512*1024):
+    """
+    Insert one row like insert_from_dict(), with the BYTEA column
+    “file_column” read from the binary file object “fp” “chunk_size”
+    bytes at a time while it is sent to the server with COPY. So the
+    value is never held in memory as a whole. COPY can’t return the
+    new row’s id, so provide it in “d” if needed.
+    """
+    columns = list(d.keys()) + [ file_column, ]
+    # COPY turns the “\\” into a single backslash, starting BYTEA’s
+    # hex format.
+    prefix = "\t".join([ copy_text(value) for value in d.values() ]
+                       + [ "\\\\x", ])
+
+    def chunks():
+        yield prefix.encode("utf-8")
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            yield chunk.hex().encode("ascii")
+        yield b"\n"
+
+    with cursor() as cc:
+        cc.copy_expert("COPY %s (%s) FROM STDIN" % ( relation,
+                                                     ", ".join(columns), ),
+                       CopyReader(chunks()), size=chunk_size*2)
 
 class SQLRepresentation(type):
     def __new__(cls, name, bases, dct):
@@ -138,7 +398,14 @@ class SQLRepresentation(type):
         return ret
 
 class Result(list):
-    def __init__(self, cursor, dbobject_class, clauses=[]):
+    def __init__(self, cursor, dbobject_class, clauses=[],
+                 count_column=False):
+        """
+        If “count_column” is set, the last column of each row is taken
+        to hold the total number of rows matching the query (as
+        computed by “COUNT(*) OVER ()”) rather than being part of the
+        dbobjects.
+        """
         self.dbobject_class = dbobject_class
 
         self.where = None
@@ -149,10 +416,17 @@ class Result(list):
                     self.where = clause
                     break
 
-        def generator():
-            for tpl in cursor:
-                yield dbobject_class(cursor.description, tpl)
-        list.__init__(self, generator())
+        if getattr(cursor, "description", None) is None:
+            list.__init__(self, cursor)
+        elif count_column:
+            make = dbobject_class.row_factory(cursor.description[:-1])
+            rows = cursor.fetchall()
+            if rows:
+                self._count = rows[0][-1]
+            list.__init__(self, [ make(tpl[:-1]) for tpl in rows ])
+        else:
+            list.__init__(self, map(dbobject_class.row_factory(
+                cursor.description), cursor))
 
     def __getitem__(self, key):
         if isinstance(key, slice):
@@ -163,21 +437,107 @@ class Result(list):
         else:
             return super().__getitem__(key)
 
-    def count(self):
+    def undefer(self, *names):
         """
-        Issue a SELECT COUNT(*) SQL query for this dbclass and where
-        clause.  Raises ValueError if not sql.where() clause was used
-        when selecting this result.
+        Load the deferred columns “names” for all the dbobjects in this
+        result with a single query. Returns the result itself.
         """
-        if self.where:
-            if self._count is None:
-                self._count =  self.dbobject_class.count(self.where)
+        cls = self.dbobject_class
+        pkey = cls.__primary_key_column__
+
+        columns = []
+        for name in names:
+            descriptor = None
+            for base in cls.__mro__:
+                if name in base.__dict__:
+                    descriptor = base.__dict__[name]
+                    break
+
+            if not isinstance(descriptor, deferred):
+                raise DbUsageException("%s.%s is not a deferred column." % (
+                    cls.__name__, name, ))
+
+            columns.append(descriptor)
+
+        # Skip objects that have the values already.
+        pending = {}
+        for dbobj in self:
+            if any(column.name not in dbobj.__row_columns__
+                   and column.name not in dbobj.__dict__
+                   for column in columns):
+                pending.setdefault(getattr(dbobj, pkey), []).append(dbobj)
+
+        if not pending:
+            return self
+
+        command = sql.select(
+            [ pkey, ] + [ column.column for column in columns ],
+            ( cls.__relation__, ),
+            sql.where(pkey, " = ANY(", sql_literal(list(pending.keys())),
+                      ")"))
 
+        with cursor() as cc:
+            command, params = rollup_sql(command)
+            cc.execute(command, params)
+            for tpl in cc:
+                for dbobj in pending.get(tpl[0], ()):
+                    for column, value in zip(columns, tpl[1:]):
+                        if column.name not in dbobj.__row_columns__:
+                            dbobj.__dict__[column.name] = value
+
+        return self
+
+    def count(self):
+        """
+        Return the count retrieved along with the rows by
+        dbobject.select_with_count() or issue a SELECT COUNT(*) SQL query
+        for this dbclass and where clause.  Raises ValueError if not
+        sql.where() clause was used when selecting this result.
+        """
+        if self._count is not None:
+            return self._count
+        elif self.where:
+            self._count = self.dbobject_class.count(self.where)
             return self._count
         else:
             raise DbUsageException(
                 "No WHERE clause provided with this result.")
 
+class StreamingResult(object):
+    """
+    Lazy iterator of dbobjects over a server-side (named) cursor. Only
+    “fetchsize” rows are held in memory at any one time. The cursor is
+    closed when the iteration is exhausted or close() is called.
+    Server-side cursors live within the current transaction, so you
+    must not commit() while iterating.
+    """
+    def __init__(self, cursor, dbobject_class):
+        self.cursor = cursor
+        self.dbobject_class = dbobject_class
+
+    def __iter__(self):
+        try:
+            make = None
+            for tpl in self.cursor:
+                # A named cursor’s description is only available after
+                # the first fetch.
+                if make is None:
+                    make = self.dbobject_class.row_factory(
+                        self.cursor.description)
+                yield make(tpl)
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.cursor.closed:
+            self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
 class PagedResultWrapper:
     def __init__(self, pagesize, page, url_for_page_f, result):
         self.pagesize = pagesize
@@ -240,6 +600,119 @@ class PagedResultWrapper:
         return self.result.__iter__()
 
 
+class column_value(object):
+    """
+    Return one value from a row class instance’s _row tuple. This is a
+    non-data descriptor: Assigning to the attribute stores the new value
+    in the instance’s __dict__, which takes precedence from then on.
+    """
+    __slots__ = ( "index", )
+
+    def __init__(self, index):
+        self.index = index
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        else:
+            return instance._row[self.index]
+
+class deferred(object):
+    """
+    A column of the dbobject class’ __relation__ that is not part of its
+    __view__, usually because it is large and rarely needed. It is
+    loaded with its own query on first access and kept in the instance’s
+    __dict__. Use Result.undefer() to load it for all the objects in a
+    result with one query instead. If a view does contain the column,
+    the value from the row is used.
+    """
+    def __init__(self, column=None):
+        self.column = column
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        if self.column is None:
+            self.column = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        row = query_one(sql.select(
+            ( self.column, ), ( owner.__relation__, ),
+            owner.primary_key_where(
+                getattr(instance, owner.__primary_key_column__))))
+        if row is None:
+            raise DbException("No row for %s." % repr(instance))
+
+        value, = row
+        instance.__dict__[self.name] = value
+        return value
+
+class class_or_instance_method(object):
+    """
+    Return the method named “class_method_name” when accessed through
+    a class and the one named “instance_method_name” when accessed
+    through an instance.
+    """
+    def __init__(self, class_method_name, instance_method_name):
+        self.class_method_name = class_method_name
+        self.instance_method_name = instance_method_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return getattr(owner, self.class_method_name)
+        else:
+            return getattr(instance, self.instance_method_name)
+
+# Maps ( dbobject class, column names, ) to row classes.
+_row_classes = {}
+def row_class_for(dbobject_class, column_names:tuple):
+    """
+    Return a subclass of “dbobject_class” that keeps the values of a
+    query result row in a single tuple, its only slot, rather than one
+    __dict__ entry per column. Row classes are created once per
+    dbobject class and set of columns and cached.
+
+    The instances still have a __dict__, since neither dbobject nor its
+    subclasses declare __slots__. Property setters, deferred columns,
+    from_dict() and plain assignments store their values there. Python
+    creates it on first use, so rows that are only read never get one.
+
+    Columns clashing with a property that has a setter are passed to
+    the setter on construction. Those clashing with a read-only property
+    are available as “_” + column name, as they have always been.
+    """
+    if "__row_columns__" in dbobject_class.__dict__:
+        dbobject_class = dbobject_class.__bases__[0]
+
+    key = ( dbobject_class, column_names, )
+    try:
+        return _row_classes[key]
+    except KeyError:
+        pass
+
+    dct = { "__slots__": ( "_row", ),
+            "__module__": dbobject_class.__module__,
+            "__qualname__": dbobject_class.__qualname__,
+            "__row_columns__": column_names, }
+    setter_columns = []
+    for index, name in enumerate(column_names):
+        attribute = getattr(dbobject_class, name, None)
+        if isinstance(attribute, property):
+            if attribute.fset is None:
+                dct["_" + name] = column_value(index)
+            else:
+                setter_columns.append( (name, index,) )
+        else:
+            dct[name] = column_value(index)
+    dct["__setter_columns__"] = tuple(setter_columns)
+
+    ret = type(dbobject_class)(dbobject_class.__name__,
+                               ( dbobject_class, ), dct)
+    _row_classes[key] = ret
+    return ret
+
 class dbobject(object, metaclass=SQLRepresentation):
     __schema__ = None
     __relation__ = None
@@ -247,21 +720,43 @@ class dbobject(object, metaclass=SQLRepresentation):
     __result_class__ = Result
     __primary_key_column__ = "id"
 
-    def __init__(self, description, values):
+    def __new__(cls, description=(), values=()):
         if values is None:
             raise ValueError("Can’t construct dbobject form None.")
 
-        self._column_names = []
-        for column, value in zip(description, values):
-            try:
-                setattr(self, column.name, value)
-            except AttributeError:
-                #raise AttributeError("Can’t set " + column.name)
-                setattr(self, "_" + column.name, value)
+        return cls.row_factory(description)(values)
 
-            self._column_names.append(column.name)
+    def __init__(self, description=(), values=()):
+        # All the work is done by the row class created in __new__().
+        pass
 
-        self.update_db = self.update_db_instance
+    @classmethod
+    def row_factory(cls, description):
+        """
+        Return a function that will construct an instance of this
+        class from a tuple of values as returned by a cursor with
+        “description”. Use this when constructing more than one object
+        from the same cursor.
+        """
+        row_class = row_class_for(cls, tuple(column.name
+                                             for column in description))
+        setter_columns = row_class.__setter_columns__
+        new = object.__new__
+
+        if setter_columns:
+            def make(values):
+                self = new(row_class)
+                self._row = values
+                for name, index in setter_columns:
+                    setattr(self, name, values[index])
+                return self
+        else:
+            def make(values):
+                self = new(row_class)
+                self._row = values
+                return self
+
+        return make
 
     @classmethod
     def from_dict(cls, data):
@@ -276,8 +771,8 @@ class dbobject(object, metaclass=SQLRepresentation):
         return self
 
     def as_dict(self):
-        ret = {}
-        for name, value in self.__dict__.items():
+        ret = dict(zip(self.__row_columns__, self._row))
+        for name, value in getattr(self, "__dict__", {}).items():
             if not name.startswith("__") and \
                not type(value) is types.MethodType:
                 ret[name] = value
@@ -332,7 +827,7 @@ class dbobject(object, metaclass=SQLRepresentation):
         return sql.where(cls.__primary_key_column__, " = ", literal)
 
     @classmethod
-    def update_db(cls, primary_key, **data):
+    def update_db_by_primary_key(cls, primary_key, **data):
         command = sql.update(cls.__relation__ or cls.__view__,
                              cls.primary_key_where(primary_key), data)
         execute(command)
@@ -341,6 +836,10 @@ class dbobject(object, metaclass=SQLRepresentation):
         self.__class__.update_db(getattr(self, self.__primary_key_column__),
                                          **data)
 
+    # Class.update_db(primary_key, **data) and object.update_db(**data)
+    update_db = class_or_instance_method("update_db_by_primary_key",
+                                         "update_db_instance")
+
     @classmethod
     def select_query(cls, *clauses):
         return sql.select("*", [cls.__view__,], *clauses)
@@ -377,6 +876,43 @@ class dbobject(object, metaclass=SQLRepresentation):
             c.execute(query, params)
             return cls.__result_class__(c, cls, clauses)
 
+    @classmethod
+    def select_with_count(cls, *clauses):
+        """
+        Like select(), but retrieve the total number of rows matching
+        the WHERE clause, ignoring OFFSET and LIMIT, with the same
+        statement. Result.count() will return it without another round
+        trip.
+        """
+        count = "COUNT(*) OVER () AS __total_count"
+
+        query = sql.select( ("*", count,), [cls.__view__,], *clauses)
+        with cursor() as c:
+            query, params = rollup_sql(query)
+            c.execute(query, params)
+            return cls.__result_class__(c, cls, clauses,
+                                        count_column=True)
+
+    @classmethod
+    def select_streaming(cls, *clauses, fetchsize=None):
+        """
+        Like select(), but return a StreamingResult that fetches its
+        rows from a server-side cursor “fetchsize” at a time rather
+        than all of them at once. Use this for batch jobs over the
+        whole database.
+        """
+        if fetchsize is None:
+            fetchsize = app.config.get("DB_STREAMING_FETCHSIZE", 100)
+
+        c = cursor(name="t4wiki_stream_%i" % next(_cursor_counter))
+        c.itersize = fetchsize
+
+        query = cls.select_query(*clauses)
+        query, params = rollup_sql(query)
+        c.execute(query, params)
+
+        return StreamingResult(c, cls)
+
     @classmethod
     def select_paged(cls, pagesize, page, url_for_page_f, *clauses):
         clauses = list(clauses)
@@ -384,7 +920,7 @@ class dbobject(object, metaclass=SQLRepresentation):
         clauses.append(sql.limit(pagesize))
 
         return PagedResultWrapper(pagesize, page, url_for_page_f,
-                                  cls.select(*clauses))
+                                  cls.select_with_count(*clauses))
 
     @classmethod
     def select_by_primary_key(cls, value):
@@ -456,7 +992,392 @@ def query_one(command, parameters=()):
         cc.execute(command, parameters)
         return cc.fetchone()
 
-def count(relation, where):
-    cmd, params = rollup_sql(where)
-    count, = query_one(f"SELECT COUNT(*) FROM search_result {cmd}", params)
-    return count
+
+# Per connection set of names of the statements PREPAREd on it. Pooled
+# connections keep their prepared statements for their whole lifetime.
+_prepared_statements = weakref.WeakKeyDictionary()
+
+# All Statement objects by name.
+statements = {}
+
+placeholder_re = re.compile(r"%(%|s)")
+class Statement(object):
+    """
+    A query run over and over with different parameters, like the
+    title lookups on each article view.
+
+    The SQL is compiled only once, on first use: “query” may be a string
+    or a function returning a t4.sql tree. Either way it must use %s
+    placeholders rather than literals for its parameters. The name
+    identifies the statement’s shape.
+
+    If “prepare” is set and the DB_PREPARED_STATEMENTS configuration
+    option is true, the statement is PREPAREd once per connection and
+    run with EXECUTE from then on, saving PostgreSQL the parsing and
+    planning.
+    """
+    def __init__(self, name, query, prepare=True):
+        if name in statements:
+            raise KeyError(f"Duplicate statement name: {repr(name)}")
+
+        self.name = name
+        self._query = query
+        self._command = None
+        self.prepare = prepare
+
+        self.calls = 0
+        self.seconds = 0.0
+
+        statements[name] = self
+
+    @property
+    def command(self):
+        if self._command is None:
+            query = self._query
+            if callable(query):
+                query = query()
+
+            if isinstance(query, sql.Part):
+                query, params = rollup_sql(query)
+                if params:
+                    raise DbUsageException(
+                        f"Statement {self.name} must not contain literals.")
+
+            self._command = query
+
+        return self._command
+
+    @property
+    def prepared_name(self):
+        return "t4wiki_" + self.name
+
+    @property
+    def postgres_command(self):
+        """
+        Our command with psycopg2’s %s placeholders replaced by
+        PostgreSQL’s $1, $2, … for PREPARE.
+        """
+        counter = itertools.count(1)
+        def replace(match):
+            if match.group(1) == "%":
+                return "%"
+            else:
+                return "$%i" % next(counter)
+        return placeholder_re.sub(replace, self.command)
+
+    def execute(self, parameters=(), cc=None):
+        if cc is None:
+            cc = cursor()
+
+        start = time.perf_counter()
+
+        if self.prepare and app.config.get("DB_PREPARED_STATEMENTS", False):
+            prepared = _prepared_statements.setdefault(cc.connection, set())
+
+            if self.name not in prepared:
+                cc.execute("PREPARE %s AS %s" % ( self.prepared_name,
+                                                  self.postgres_command, ))
+                prepared.add(self.name)
+
+            if parameters:
+                command = "EXECUTE %s(%s)" % (
+                    self.prepared_name, ", ".join(["%s"] * len(parameters)))
+            else:
+                command = "EXECUTE " + self.prepared_name
+
+            try:
+                cc.execute(command, parameters)
+            except psycopg2.Error as e:
+                # Someone DEALLOCATEd or DISCARDed behind our back.
+                # PREPARE again next time.
+                if e.pgcode == "26000": # invalid_sql_statement_name
+                    prepared.discard(self.name)
+                raise
+        else:
+            cc.execute(self.command, parameters)
+
+        self.calls += 1
+        self.seconds += time.perf_counter() - start
+
+        return cc
+
+    def query_one(self, parameters=()):
+        with self.execute(parameters) as cc:
+            return cc.fetchone()
+
+    def select_one(self, parameters=(), dbobject_class=dbobject):
+        with self.execute(parameters) as cc:
+            tpl = cc.fetchone()
+            if tpl is None:
+                return None
+            else:
+                return dbobject_class(cc.description, tpl)
+
+    def statistics(self) -> dict:
+        if self.calls:
+            mean = self.seconds / self.calls
+        else:
+            mean = None
+
+        return { "name": self.name,
+                 "calls": self.calls,
+                 "seconds": self.seconds,
+                 "mean": mean, }
+
+def statement_statistics():
+    """
+    Return a list of Statement.statistics() dicts, the statements that
+    took the most time in total first. Counters are per process.
+    """
+    ret = [ statement.statistics() for statement in statements.values() ]
+    ret.sort(key=lambda d: d["seconds"], reverse=True)
+    return ret
+
+
+class ConcurrentQuery(object):
+    """
+    A read-only query to be passed to run_concurrently(). “command” may
+    be a t4.sql tree or a string with “parameters”. If a
+    “dbobject_class” is given, the result will be a list of its
+    instances, a list of tuples otherwise.
+    """
+    def __init__(self, command, parameters=(), dbobject_class=None):
+        if isinstance(command, sql.Part):
+            if parameters:
+                raise ValueError(
+                    "Can’t provide parameters with t4.sql statement.")
+            command, parameters = rollup_sql(command)
+
+        self.command = command
+        self.parameters = parameters
+        self.dbobject_class = dbobject_class
+
+        self.description = None
+        self.rows = None
+
+    def run(self, cursor):
+        with cursor as cc:
+            cc.execute(self.command, self.parameters)
+            self.description = cc.description
+            self.rows = cc.fetchall()
+
+    @property
+    def result(self):
+        if self.dbobject_class is None:
+            return self.rows
+        else:
+            make = self.dbobject_class.row_factory(self.description)
+            return [ make(tpl) for tpl in self.rows ]
+
+    def one(self):
+        """
+        Return the first row as tuple (like query_one()) or None.
+        """
+        if self.rows:
+            return self.rows[0]
+        else:
+            return None
+
+_executor = None
+_executor_lock = threading.Lock()
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=app.config.get("DB_CONCURRENT_QUERIES", 4),
+                thread_name_prefix="t4wiki-db")
+        return _executor
+
+def _run_on_pooled_connection(pool, dbconn, query, debug_sql, profile):
+    try:
+        query.run(wrap_cursor(dbconn.cursor(), debug_sql, profile))
+    finally:
+        pool.putconn(dbconn)
+
+def run_concurrently(*queries):
+    """
+    Run independent, read-only ConcurrentQuery objects at the same
+    time. The first one runs on the request’s connection, the others on
+    connections taken from the pool, in a thread pool of
+    DB_CONCURRENT_QUERIES threads. If the pool has no connection to
+    spare right away, queries run on the request’s connection one after
+    the other, as before.
+
+    The pooled connections do not see what has not been committed on
+    the request’s connection. Do not use this for read-after-write.
+    They come from the same pool as the request’s connection, i.e. the
+    replica for @read_only views.
+
+    Returns the queries’ results as a list.
+    """
+    get_dbconn()
+    pool = getattr(g, "dbpool", None)
+
+    debug_sql = app.debug_sql
+    if app.profile_sql:
+        profile = g.get("sql_profile", None)
+    else:
+        profile = None
+
+    futures = []
+    local = [ queries[0], ]
+    for query in queries[1:]:
+        dbconn = None
+        if pool is not None:
+            try:
+                dbconn = pool.getconn(timeout=0)
+            except PoolExhausted:
+                pass
+
+        if dbconn is None:
+            local.append(query)
+        else:
+            try:
+                futures.append(get_executor().submit(
+                    _run_on_pooled_connection, pool, dbconn, query,
+                    debug_sql, profile))
+            except BaseException:
+                pool.putconn(dbconn)
+                raise
+
+    for query in local:
+        query.run(cursor())
+
+    for future in futures:
+        future.result()
+
+    return [ query.result for query in queries ]
+
+
+# Expensive queries, like the full text search, get a statement timeout,
+# are cancelled when the client goes away and only so many of them run
+# at the same time, so they can’t take all of the pool’s connections.
+_expensive_query_semaphore = None
+_expensive_query_lock = threading.Lock()
+def _get_expensive_query_semaphore():
+    global _expensive_query_semaphore
+    with _expensive_query_lock:
+        if _expensive_query_semaphore is None:
+            concurrency = app.config.get(
+                "EXPENSIVE_QUERY_CONCURRENCY",
+                max(1, app.config.get("DBPOOL_MAXCONN", 10) // 2))
+            _expensive_query_semaphore = threading.BoundedSemaphore(
+                concurrency)
+        return _expensive_query_semaphore
+
+def client_socket():
+    """
+    Return the socket connected to the client, if the WSGI server lets
+    us know (gunicorn and werkzeug’s development server do), None
+    otherwise.
+    """
+    if not has_request_context():
+        return None
+
+    environ = request.environ
+    return environ.get("gunicorn.socket", environ.get("werkzeug.socket"))
+
+def client_disconnected(sock):
+    """
+    Determine whether the client has closed “sock” without taking
+    anything from its input.
+    """
+    try:
+        readable, writable, error = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+class DisconnectWatchdog(threading.Thread):
+    """
+    Cancel whatever is running on “dbconn” as soon as the client closes
+    “sock”. Checks every “interval” seconds until stop() is called.
+    """
+    def __init__(self, sock, dbconn, interval=0.5):
+        super().__init__(name="t4wiki-disconnect-watchdog", daemon=True)
+        self.sock = sock
+        self.dbconn = dbconn
+        self.interval = interval
+        self.cancelled = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            if client_disconnected(self.sock):
+                self.cancelled = True
+                self.dbconn.cancel()
+                return
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+@contextlib.contextmanager
+def expensive_query(name, timeout=5.0):
+    """
+    Context manager for expensive queries on the request’s connection.
+
+    • Statements in the with block time out after STATEMENT_TIMEOUTS[name]
+      seconds, or “timeout” if that is not configured, and raise
+      QueryTimeout.
+    • At most EXPENSIVE_QUERY_CONCURRENCY expensive queries (default:
+      half the pool) run at the same time in this process. If no slot
+      becomes available within EXPENSIVE_QUERY_WAIT seconds, QueryTimeout
+      is raised without querying the database at all.
+    • If the client disconnects meanwhile, the query is cancelled and
+      ClientDisconnected is raised.
+
+    The block runs within a savepoint, so the transaction remains usable
+    after a timeout.
+    """
+    timeout = app.config.get("STATEMENT_TIMEOUTS", {}).get(name, timeout)
+
+    semaphore = _get_expensive_query_semaphore()
+    if not semaphore.acquire(
+            timeout=app.config.get("EXPENSIVE_QUERY_WAIT", 2.0)):
+        raise QueryTimeout("Too many expensive queries running for "
+                           "%s." % name)
+
+    try:
+        dbconn = get_dbconn()
+        with dbconn.cursor() as cc:
+            cc.execute("SHOW statement_timeout")
+            previous, = cc.fetchone()
+            cc.execute("SAVEPOINT expensive_query")
+            cc.execute("SELECT set_config('statement_timeout', %s, true)",
+                       ( "%ims" % (timeout * 1000), ))
+
+        sock = client_socket()
+        if sock is None:
+            watchdog = None
+        else:
+            watchdog = DisconnectWatchdog(sock, dbconn)
+            watchdog.start()
+
+        try:
+            yield
+        except psycopg2.extensions.QueryCanceledError as exc:
+            with dbconn.cursor() as cc:
+                cc.execute("ROLLBACK TO SAVEPOINT expensive_query")
+
+            if watchdog is not None and watchdog.cancelled:
+                raise ClientDisconnected(
+                    "Client went away during %s." % name) from exc
+            else:
+                logger.warning("%s exceeded its statement timeout "
+                               "of %.1f seconds.", name, timeout)
+                raise QueryTimeout("%s took longer than %.1f seconds." % (
+                    name, timeout, )) from exc
+        else:
+            with dbconn.cursor() as cc:
+                cc.execute("SELECT set_config('statement_timeout', %s, true)",
+                           ( previous, ))
+                cc.execute("RELEASE SAVEPOINT expensive_query")
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+    finally:
+        semaphore.release()
@@ -0,0 +1,244 @@
+"""
+A thread safe pool of psycopg2 connections.
+
+psycopg2’s own pool classes raise PoolError when they run dry and never
+look at the connections they hand out. This pool blocks for a
+configurable time waiting for a connection to be returned, checks
+connections that have been idle for a while before handing them out
+and keeps some statistics on what it is doing.
+"""
+
+import time, threading, collections, logging
+import psycopg2, psycopg2.extensions
+
+logger = logging.getLogger(__name__)
+
+class PoolExhausted(Exception): pass
+
+class ConnectionPool(object):
+    def __init__(self, datasource:dict, minconn=1, maxconn=10,
+                 timeout=30.0, health_check_interval=60.0,
+                 search_path=None):
+        """
+        • “datasource”: Keyword arguments for psycopg2.connect()
+        • “minconn”: Number of connections opened right away and
+          kept open when idle.
+        • “maxconn”: Maximum number of connections handed out at any one
+          time. Callers of getconn() will block if it is reached.
+        • “timeout”: Seconds getconn() waits for a connection to become
+          available before raising PoolExhausted.
+        • “health_check_interval”: Connections idle for longer than this
+          many seconds will run a “SELECT 1” before they are handed out.
+        • “search_path”: Comma separated list of schemas set as each
+          connection’s search_path when it is opened, so it holds for
+          every transaction and survives rollbacks.
+        """
+        if minconn > maxconn:
+            raise ValueError("minconn must not be larger than maxconn.")
+
+        self.datasource = datasource
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.search_path = search_path
+
+        self._lock = threading.Condition()
+
+        # ( connection, time.monotonic() when returned, ) tuples.
+        # The most recently returned connection is on the right.
+        self._idle = collections.deque()
+        self._used = set()
+
+        # Number of connections being opened or checked right now.
+        # They are neither idle nor used, but count towards maxconn.
+        self._pending = 0
+
+        self._stats = collections.Counter()
+        self._closed = False
+
+        for a in range(minconn):
+            self._idle.append( (self._connect(), time.monotonic(),) )
+
+    @classmethod
+    def from_config(cls, config, datasource_key="DATASOURCE", **kw):
+        """
+        Create a pool from a Flask config (or any other dict) using the
+        DBPOOL_* settings. Keyword arguments override them.
+        """
+        params = { "minconn": config.get("DBPOOL_MINCONN", 1),
+                   "maxconn": config.get("DBPOOL_MAXCONN", 10),
+                   "timeout": config.get("DBPOOL_TIMEOUT", 30.0),
+                   "health_check_interval": config.get(
+                       "DBPOOL_HEALTH_CHECK_INTERVAL", 60.0),
+                   "search_path": config.get("DBPOOL_SEARCH_PATH",
+                                             "wiki, uploads, public"), }
+        params.update(kw)
+        return cls(config[datasource_key], **params)
+
+    def connect_parameters(self):
+        """
+        Return the keyword arguments for psycopg2.connect(): our
+        datasource with the search_path added to its “options”.
+        """
+        ret = dict(self.datasource)
+        if self.search_path:
+            # Spaces separate options.
+            schemas = [ schema.strip() for schema in
+                        self.search_path.split(",") ]
+            option = "-c search_path=" + ",".join(schemas)
+            if ret.get("options"):
+                ret["options"] += " " + option
+            else:
+                ret["options"] = option
+        return ret
+
+    def _connect(self):
+        self._stats["connects"] += 1
+        return psycopg2.connect(**self.connect_parameters())
+
+    def _discard(self, conn):
+        self._stats["discarded"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        self._stats["health_checks"] += 1
+        try:
+            with conn.cursor() as cc:
+                cc.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        else:
+            return True
+
+    def getconn(self, timeout=None):
+        """
+        Return a connection from the pool, opening a new one if none
+        is idle and maxconn has not been reached. Block until one is
+        returned otherwise, for “timeout” seconds, which defaults to
+        the pool’s timeout.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise PoolExhausted("Connection pool has been closed.")
+
+                while not self._idle and \
+                      len(self._used) + self._pending >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolExhausted(
+                            "No database connection available "
+                            "after %.1f seconds." % timeout)
+                    self._stats["waits"] += 1
+                    self._lock.wait(remaining)
+
+                self._pending += 1
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    conn, idle_since = None, None
+
+            # Connecting and health checks happen outside the lock so
+            # other threads may return connections meanwhile.
+            try:
+                if conn is None:
+                    conn = self._connect()
+                elif not self._is_healthy(conn, idle_since):
+                    logger.warning("Discarding broken database connection.")
+                    self._discard(conn)
+                    conn = None
+            except BaseException:
+                with self._lock:
+                    self._pending -= 1
+                    self._lock.notify()
+                raise
+
+            with self._lock:
+                self._pending -= 1
+
+                if conn is not None:
+                    self._used.add(conn)
+                    self._stats["checkouts"] += 1
+                    self._stats["wait_seconds"] += time.monotonic() - started
+                    return conn
+                else:
+                    # We discarded an unhealthy connection; its place is
+                    # free now.
+                    self._lock.notify()
+
+    def putconn(self, conn, close=False):
+        """
+        Return “conn” to the pool. Whatever transaction is still open
+        on it will be rolled back. Connections in an unusable state
+        are closed.
+        """
+        if not close and not conn.closed:
+            try:
+                if conn.get_transaction_status() != \
+                   psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                    self._stats["rollbacks"] += 1
+            except psycopg2.Error:
+                close = True
+
+        with self._lock:
+            self._used.discard(conn)
+
+            if close or conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                self._idle.append( (conn, time.monotonic(),) )
+
+            self._stats["returns"] += 1
+            self._lock.notify()
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            while self._idle:
+                conn, idle_since = self._idle.pop()
+                self._discard(conn)
+            self._lock.notify_all()
+
+    def statistics(self) -> dict:
+        """
+        Return a dict with the current size of the pool and the counters
+        accumulated since it was created.
+        """
+        with self._lock:
+            ret = { "minconn": self.minconn,
+                    "maxconn": self.maxconn,
+                    "idle": len(self._idle),
+                    "used": len(self._used),
+                    "pending": self._pending, }
+            for key in ( "connects", "checkouts", "returns", "waits",
+                         "timeouts", "health_checks", "discarded",
+                         "rollbacks", ):
+                ret[key] = self._stats[key]
+            ret["wait_seconds"] = round(self._stats["wait_seconds"], 6)
+            return ret
+
+    def __repr__(self):
+        stats = self.statistics()
+        return "<%s idle=%i used=%i max=%i>" % ( self.__class__.__name__,
+                                                 stats["idle"],
+                                                 stats["used"],
+                                                 self.maxconn, )
@@ -9,3 +9,8 @@ class TitleUnavailable(WikiException):
     def __str__(self):
         titles = [ et.title for et in self.existing_titles ]
         return super().__str__() + " " + repr(titles)
+
+class FilenameUnavailable(WikiException):
+    def __init__(self, message, filenames):
+        super().__init__(message)
+        self.filenames = filenames
@@ -1,4 +1,5 @@
-import sys, collections
+import sys, re, json, collections
+from urllib.parse import urlencode
 
 from flask import request, session
 
@@ -8,7 +9,7 @@ from sqlclasses import sql
 from ll.xist import xsc
 from ll.xist.ns import html
 
-from .db import query, rollup_sql
+from .db import sql_literal
 from .utils import rget
 
 def pageget():
@@ -148,9 +149,35 @@ class empty_orderby_t:
     def display_class(self, t):
         return ""
 
+orderby_column_re = re.compile(r"^\s*([\w\.]+)(?:\s+(ASC|DESC))?\s*$",
+                               re.IGNORECASE)
+def parse_orderby(expression):
+    """
+    Return a list of ( column name, descending?, ) tuples for a simple
+    ORDER BY expression like “wordcount ASC, ctime DESC” or None, if
+    the expression is more complicated than that.
+    """
+    ret = []
+    for part in expression.split(","):
+        match = orderby_column_re.match(part)
+        if match is None:
+            return None
+        column, direction = match.groups()
+        ret.append( (column, (direction or "").upper() == "DESC",) )
+    return ret
+
 class OrderByOption(FormParamOption):
     sql_expression_class = sql.orderby
 
+    def __init__(self, expression, label, *args, **kw):
+        super().__init__(expression, label, *args, **kw)
+
+        # Used by KeysetPager
+        if type(expression) is str:
+            self.order_columns = parse_orderby(expression)
+        else:
+            self.order_columns = None
+
 class OrderByHandler(FormParamHandler):
     option_class = OrderByOption
 
@@ -171,7 +198,7 @@ class PaginationHandler(FormParamHandler):
     @property
     def page(self):
         page = pageget()
-        if page > int(self.count / self.pagesize):
+        if self.count is not None and page > int(self.count / self.pagesize):
             page = 0
         return page
 
@@ -233,197 +260,269 @@ class ViewOption(FormParamOption):
 class ViewsHandler(FormParamHandler):
     option_class = ViewOption
 
-# AndreasPager, named after my good friend Andreas Junge, who came up with
-# this design as a programming challange, display from–to values for each
-# the the pagerʼs pages. The PagerOptions must be identical to the
-# OrderByOptions used to formulate the query and go into the OrderByHandler
-# as well as the AndreasPager below.
+# AndreasPagerOption, named after my good friend Andreas Junge, who came up
+# with this design as a programming challange, display from–to values for
+# the pagerʼs pages. The KeysetPager labels the current page that way.
 class AndreasPagerOption(OrderByOption):
     def __init__(self, expression, label, group=None,
                  extra_button_class=None, id=None,
-                 pager_button_label_f=lambda s: str(s),
-                 select_expressions=None,
-                 midlinknum=5):
+                 pager_button_label_f=lambda s: str(s)):
         """
-        • “pager_button_label_f”: The AndreasPager knows the dbobject class
-          for the result to be displayed. Objects of that class will be
-          instantiated for each row and passed to the pager_button_label_f.
-          The function will be called as: pager_button_label_f(dbobject). 
-          If None, a page number will be displayed, no a–b pattern. 
-        • “select_expressions” is a tuple of column names used in the SELECT.
-          If None, “*” will be used fetching all expressions.
+        • “pager_button_label_f”: The KeysetPager passes the first and
+          the last dbobject on the current page to this function as
+          pager_button_label_f(dbobject) and displays an a–b label.
+          If None, no label will be displayed.
         """
         super().__init__(expression, label, group, extra_button_class, id)
         self.pager_button_label_f = pager_button_label_f
-        self.select_expressions = select_expressions
-        self.midlinknum = midlinknum
-        
-class AndreasPager(PaginationHandler):
-    def __init__(self, pagesize, count, orderby_handler,
-                 dbclass, where, orderby, *sqlclauses):
+
+class KeysetPager(object):
+    """
+    Pagination without OFFSET. Rather than a page number, the links to
+    the next and previous pages carry the sort key of the last (first)
+    row on the current page and the query selects the rows after
+    (before) that key. Given an index matching the ORDER BY, page 500
+    costs as much as page one.
+
+    The sort key consists of the active OrderByOption’s columns plus the
+    primary key to break ties. The option’s expression must be a simple
+    list of columns, each optionally followed by ASC or DESC. The column
+    names must be available as attributes of the dbclass’ objects.
+    There are no page numbers: The widget links to the first, previous,
+    next and last pages. If the active option has a
+    pager_button_label_f (see AndreasPagerOption), the widget shows
+    the current page’s range, labeled by its first and last rows.
+    """
+    def __init__(self, pagesize, orderby_handler, dbclass, where,
+                 *sqlclauses, nullable=()):
         """
-        The orderby_handler here must be initialized with
-        AndreasPagerOptions.
+        “nullable” names the columns that may be NULL, like those from
+        the outer side of a LEFT JOIN. They sort last going forward and
+        are compared with explicit IS NULL branches. The others are
+        assumed NOT NULL, so indexes without NULLS LAST match them.
         """
-        super().__init__(pagesize, count)
+        self.pagesize = pagesize
+        self.nullable = set(nullable)
         self.orderby_handler = orderby_handler
         self.dbclass = dbclass
         self.where = where
-        self.orderby = orderby
         self.sqlclauses = sqlclauses
 
-    def run_query(self):
-        expressions = self.orderby_handler.active.select_expressions
-        if expressions is None:
-            expressions = "*"
-
-        select = sql.select(expressions, (self.dbclass.__view__,),
-                            self.where, self.orderby, *self.sqlclauses)
-
-        with_ = sql.with_(
-            ("res", select,),
-            ("e", sql.select(
-                ("ROW_NUMBER() OVER () AS __row_id", "*"), ("res",)),),
-            ("tail", sql.select( ("MAX(__row_id) AS tail",
-                                  "%i AS __pagesize" % self.pagesize),
-                                 ("e",))),
-            sql.select( expressions,
-                        ("e", "tail"),
-                        sql.where("__row_id %% __pagesize = 0",
-                                  " OR ",
-                                  "(__row_id - 1) %% __pagesize = 0",
-                                  " OR ",
-                                  "__row_id = tail.tail")))
-
-        return query(with_, dbobject_class=self.dbclass)
+        columns = orderby_handler.active.order_columns
+        if columns is None:
+            raise ValueError("Keyset pagination needs a simple ORDER BY "
+                             "expression.")
+        columns = list(columns)
 
-    def widget(self, extra_class="", **kw):
+        primary_key = dbclass.__primary_key_column__
+        if primary_key not in [ column for column, desc in columns ]:
+            columns.append( (primary_key, columns[-1][1],) )
+        self.columns = columns
+
+        self.has_previous = False
+        self.has_next = False
+        self.first_key = None
+        self.last_key = None
+        self.label = None
+
+    @property
+    def needed(self):
+        return self.has_previous or self.has_next
+
+    def orderby(self, forward=True):
+        def term(column, desc):
+            ret = "%s %s" % ( column, "DESC" if desc == forward else "ASC", )
+            if column in self.nullable:
+                ret += " NULLS LAST" if forward else " NULLS FIRST"
+            return ret
+
+        return sql.orderby(", ".join([ term(column, desc)
+                                       for column, desc in self.columns ]))
+
+    def key_of(self, dbobj):
+        return [ getattr(dbobj, column.rsplit(".", 1)[-1])
+                 for column, desc in self.columns ]
+
+    @staticmethod
+    def encode_key(key):
+        def default(value):
+            if hasattr(value, "isoformat"):
+                return value.isoformat()
+            else:
+                return str(value)
+        return json.dumps(key, default=default)
+
+    def decode_key(self, s):
+        try:
+            key = json.loads(s)
+        except ValueError:
+            return None
+
+        if type(key) is not list or len(key) != len(self.columns):
+            return None
+
+        # The key comes from the request. Anything but scalars is
+        # somebody else’s idea of a sort key.
+        for value in key:
+            if value is not None and type(value) not in ( str, int, float, ):
+                return None
+
+        return key
+
+    def key_where(self, key, forward):
         """
-        midlinknum => Number of links “in the middle” between to optional
-           “…” items. 
-        extra_class => .pagination-large, .pagination-small,
-                           or .pagination-mini
+        Return an sql.where() selecting the rows after “key” in the
+        sort order if “forward” is True, those before it otherwise.
         """
-        if self.count is None: return xsc.Frag()
-        if self.count <= self.pagesize: return xsc.Frag()
+        literals = [ sql_literal(value) for value in key ]
 
-        midlinknum = self.orderby_handler.active.midlinknum
-        label_f = self.orderby_handler.active.pager_button_label_f
+        def op(desc):
+            if desc == forward:
+                return "<"
+            else:
+                return ">"
+
+        directions = set([ desc for column, desc in self.columns ])
+        if len(directions) == 1 and \
+           not any(column in self.nullable for column, desc in self.columns):
+            # A row comparison can use a multi-column index directly.
+            return sql.where("(%s) %s (%s)" % (
+                ", ".join([ column for column, desc in self.columns ]),
+                op(directions.pop()),
+                ", ".join(literals), ))
+
+        def equal(column, value, literal):
+            if value is None:
+                return "%s IS NULL" % column
+            else:
+                return "%s = %s" % ( column, literal, )
+
+        def beyond(column, desc, value, literal):
+            # Rows past “value” in this column, or None if there are
+            # none. NULLs sort last going forward.
+            if value is None:
+                if forward or column not in self.nullable:
+                    return None
+                else:
+                    return "%s IS NOT NULL" % column
+            else:
+                ret = "%s %s %s" % ( column, op(desc), literal, )
+                if forward and column in self.nullable:
+                    ret = "(%s OR %s IS NULL)" % ( ret, column, )
+                return ret
+
+        ors = []
+        for idx, (column, desc) in enumerate(self.columns):
+            condition = beyond(column, desc, key[idx], literals[idx])
+            if condition is None:
+                continue
+
+            ands = [ equal(c, value, literal)
+                     for (c, d), value, literal in zip(self.columns[:idx],
+                                                       key, literals) ]
+            ands.append(condition)
+            ors.append("(" + " AND ".join(ands) + ")")
+
+        if not ors:
+            return sql.where("false")
+
+        where = "(" + " OR ".join(ors) + ")"
+
+        # The OR chain by itself gives the planner no range to scan.
+        # Bound the first column, so it can start the index scan at
+        # the key.
+        column, desc = self.columns[0]
+        if key[0] is not None and column not in self.nullable:
+            where = "%s %s= %s AND %s" % ( column, op(desc), literals[0],
+                                           where, )
+
+        return sql.where(where)
+
+    def select(self):
+        """
+        Return the rows of the page requested by the “after”, “before”
+        or “last” request parameter and set has_previous and has_next.
+        """
+        forward = True
+        key = None
+
+        after = rget("after")
+        before = rget("before")
+
+        if after:
+            key = self.decode_key(after)
+            self.has_previous = (key is not None)
+        elif before:
+            key = self.decode_key(before)
+            forward = (key is None)
+            self.has_next = (key is not None)
+        elif rget("last"):
+            forward = False
+
+        where = self.where
+        if key is not None:
+            key_where = self.key_where(key, forward)
+            if where is None:
+                where = key_where
+            else:
+                where = where.and_(key_where)
 
-        pagecount = int(self.count / self.pagesize)
-        if self.count % self.pagesize > 0:
-            pagecount += 1
+        # Select one extra row to find out whether there is more.
+        result = self.dbclass.select(where, self.orderby(forward),
+                                     sql.limit(self.pagesize + 1),
+                                     *self.sqlclauses)
+        more = (len(result) > self.pagesize)
+        result = result[:self.pagesize]
 
-        if label_f is None:
-            pages = [ (a, str(a+1)) for a in range(pagecount)]
+        if forward:
+            self.has_next = more
         else:
-            rows = self.run_query()
-            def pages():
-                i = iter(rows)
-                p = 0
-                while True:
-                    try:
-                        yield (p, label_f(next(i)) + "–" + label_f(next(i)),)
-                        p += 1
-                    except StopIteration:
-                        break
-            pages = list(pages())
-                
-        current = pageget()
-
-        nav = html.nav()
-        ret = xsc.Frag(nav)
-        mainul = html.ul(class_="pagination" + extra_class, **kw)
-        nav.append(mainul)
-
-        def addli(ul, page):
-            p, label = page
-            
-            if p >= 0 and p < pagecount:
-                href = str(p)
-                if p == current:
-                    cls = "active"
-                else:
-                    cls = ""
+            result.reverse()
+            self.has_previous = more
+
+        if len(result) > 0:
+            self.first_key = self.encode_key(self.key_of(result[0]))
+            self.last_key = self.encode_key(self.key_of(result[-1]))
+
+            label_f = getattr(self.orderby_handler.active,
+                              "pager_button_label_f", None)
+            if label_f is not None:
+                self.label = label_f(result[0]) + "–" + label_f(result[-1])
+
+        return result
+
+    def href(self, **params):
+        params[self.orderby_handler.param_name] = \
+            self.orderby_handler.active.id
+        return request.path + "?" + urlencode(params)
+
+    def widget(self, extra_class="", **kw):
+        if not self.needed:
+            return xsc.Frag()
+
+        ul = html.ul(class_="pagination " + extra_class, **kw)
+
+        def li(label, href, enabled):
+            if enabled:
+                cls = ""
             else:
                 href = None
                 cls = "disabled"
 
-            if ul == mainul:
-                li = html.li(html.a(label, href=href,
-                                    class_="page-link to-page"),
-                             class_="page-item " + cls)
-            else:
-                li = html.li(html.a(label, href=href,
-                                    class_="dropdown-item to-page"))
-
-            ul.append(li)
-            
-        def addlis(ul, pages):
-            for page in pages:
-                addli(ul, page)
-
-        def make_dropdown():
-            li = html.li(class_="page-item")
-            button = html.a("…", class_="page-link ellipsis",
-                            **{"data-bs-toggle": "dropdown"})
-            li.append(button)
-            
-            ul = html.ul(class_="dropdown-menu")
-            li.append(ul)
-
-            mainul.append(li)
-            
-            return ul
-
-        addli(mainul, (current-1, "«"))
-
-        if pagecount <= midlinknum+1:
-            addlis(mainul, pages)
-        else:
-            if current < midlinknum - 1:
-                # only a right …
-                addlis(mainul, pages[:midlinknum])
-            
-                dropdown = make_dropdown()
-                addlis(dropdown, pages[midlinknum:-1])
-
-                addli(mainul, pages[-1])
-            elif current > pagecount - midlinknum - 1:
-                # only a left …
-                addli(mainul, pages[0])
-                
-                r = pagecount - midlinknum                
-                dropdown = make_dropdown()
-                addlis(dropdown, pages[1:r])
-
-                addlis(mainul, pages[r:])                
-            else:
-                # both (current // midlinknum) * midlinknum  #                 
-                l = current - midlinknum//2
-                r = l + midlinknum
-
-                addli(mainul, pages[0])
-                
-                ldropdown = make_dropdown()
-                addlis(ldropdown, pages[1:l])
+            ul.append(html.li(html.a(label, href=href, class_="page-link"),
+                              class_="page-item " + cls))
 
-                addlis(mainul, pages[l:r])
-                       
-                rdropdown = make_dropdown()
-                addlis(rdropdown, pages[r:-1])
+        li("«« First", self.href(), self.has_previous)
+        li("« Previous", self.href(before=self.first_key), self.has_previous)
+        if self.label is not None:
+            ul.append(html.li(html.span(self.label, class_="page-link"),
+                              class_="page-item active"))
+        li("Next »", self.href(after=self.last_key), self.has_next)
+        li("Last »»", self.href(last=1), self.has_next)
 
-                addli(mainul, pages[-1])
-            
-        addli(mainul, (current+1, "»"))
+        return html.nav(ul)
 
-        ret.append(html.input(name=self.param_name, type="text",
-                              class_="formparam-input",
-                              **{"data-for": self.param_name}))
-
-        return ret
 
-    
 class FilterFormHandler(object):
     def __init__(self, session_identifyer, *parameters):
         self._session_identifyer = session_identifyer
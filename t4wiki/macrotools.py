@@ -1,9 +1,13 @@
 from ll.xist import xsc
 from ll.xist.ns import html
 
+# articles.mjs sets src, srcset, sizes, width and height from the
+# upload’s info.
+
 def block_level_figure(image_filename, description):
     return html.figure(
         html.img(class_="rounded preview-image preview-1800",
+                 loading="lazy", decoding="async",
                  **{"data-filename": image_filename}),
         html.figcaption(description, class_="figure-caption"),
         class_="figure t4wiki-figure")
@@ -11,6 +15,7 @@ def block_level_figure(image_filename, description):
 def float_right_image(image_filename, description):
     return html.figure(
         html.img(class_="rounded preview-image preview-300",
+                 loading="lazy", decoding="async",
                  **{"data-filename": image_filename}),
         html.figcaption(description, class_="figure-caption"),
         class_="figure t4wiki-figure float-end small")
@@ -14,7 +14,7 @@ from . import model
 from . import html_markup
 from .exceptions import TitleUnavailable
 from .context import Context, get_languages
-from .db import insert_from_dict, execute, query_one
+from .db import insert_many, execute, query_one
 from .utils import title2path
 
 title_re = re.compile(r"""
@@ -243,35 +243,30 @@ def extract_article_from_html(source, format,
 
 
 def update_titles_for(id, titles, root_language):
-    tsvectors = []
     execute("DELETE FROM wiki.article_title WHERE article_id = %i" % id)
-    for index, title in enumerate(titles):
-        insert_from_dict( "wiki.article_title",
-                          {
-                              "article_id": id,
-                              "title": title.title,
-                              "namespace": title.namespace,
-                              "language": (title.lang or root_language).iso,
-                              "is_main_title": bool(index == 0)
-                          }, retrieve_id=False)
-        tsvectors.append(title.to_tsvector(root_language))
-
-    tsvector = "||".join(tsvectors)
+    insert_many( "wiki.article_title",
+                 [ { "article_id": id,
+                     "title": title.title,
+                     "namespace": title.namespace,
+                     "language": (title.lang or root_language).iso,
+                     "is_main_title": bool(index == 0) }
+                   for index, title in enumerate(titles) ] )
+
+    tsvector = "||".join([ title.to_tsvector(root_language)
+                           for title in titles ])
     model.Article.update_db(id, titles_tsvector=sql.expression(tsvector))
 
 def update_links_for(id, links):
     execute("DELETE FROM wiki.article_link WHERE article_id = %i" % id)
-    for link in links:
-        insert_from_dict( "wiki.article_link",
-                          { "article_id": id, "target_title": link },
-                          retrieve_id=False)
+    insert_many( "wiki.article_link",
+                 [ { "article_id": id, "target_title": link }
+                   for link in links ] )
 
 def update_includes_for(id, includes):
     execute("DELETE FROM wiki.article_include WHERE article_id = %i" % id)
-    for include in includes:
-        insert_from_dict( "wiki.article_include",
-                          { "article_id": id, "wants_to_include": include },
-                          retrieve_id=False)
+    insert_many( "wiki.article_include",
+                 [ { "article_id": id, "wants_to_include": include }
+                   for include in includes ] )
 
 def get_user_info(id):
     info, = query_one("SELECT user_info FROM wiki.article "
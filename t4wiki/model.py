@@ -4,8 +4,11 @@ from flask import url_for
 from t4 import sql
 
 from .utils import get_site_url, title2path
-from .db import dbobject, query_one, cursor, execute_with_template, execute
+from .db import (dbobject, query_one, cursor, execute, get_sql_file_path,
+                 Statement, deferred, get_pool)
 from .context import get_languages
+from .upload_store import get_upload_store
+from .preview_gc import preview_dir_name
 from . import markup
 
 class has_title_and_namespace:
@@ -37,6 +40,26 @@ class has_title_and_namespace:
     def href(self):
         return "/" + title2path(self.full_title)
 
+# The lookups made on every article view.
+# full_title is a generated column equal to ArticleTitle.title_where()’s
+# expression. Unlike that expression it is indexed.
+id_by_title_statement = Statement(
+    "article_id_by_title",
+    lambda: sql.select( ("article_id",),
+                        ("wiki.article_title",),
+                        sql.where("full_title = %s::citext") ))
+
+id_by_bibtex_key_statement = Statement(
+    "article_id_by_bibtex_key",
+    lambda: sql.select( ("id",),
+                        ("wiki.article",),
+                        sql.where("bibtex_key = %s") ))
+
+article_title_by_full_title_statement = Statement(
+    "article_title_by_full_title",
+    "SELECT * FROM wiki.article_title "
+    " WHERE full_title = %s::citext LIMIT 1")
+
 class Article(dbobject, has_title_and_namespace):
     __schema__ = "wiki"
     __relation__ = "article"
@@ -44,16 +67,11 @@ class Article(dbobject, has_title_and_namespace):
 
     @staticmethod
     def id_by_title(title):
-        return query_one(sql.select( ("article_id",),
-                                     ("wiki.article_title",),
-                                     ArticleTitle.title_where(title), ))
+        return id_by_title_statement.query_one( (title,) )
 
     @staticmethod
     def id_by_bibtex_key(key):
-        return query_one(sql.select( ("id",),
-                                     ("wiki.article",),
-                                     sql.where("bibtex_key = ",
-                                               sql.string_literal(key)) ))
+        return id_by_bibtex_key_statement.query_one( (key,) )
 
     def form_url(self, form):
         return f"{get_site_url()}/articles/{form}_form.cgi?id={self.id}"
@@ -69,11 +87,8 @@ class Article(dbobject, has_title_and_namespace):
     def id_where(self):
         return sql.where("article_id = %i" % self.id)
 
-    @property
-    def source(self):
-        source, = query_one("SELECT source "
-                            "  FROM wiki.article WHERE id = %i" % self.id)
-        return source
+    # Large columns not in article_info.
+    source = deferred()
 
     # @property
     # def bibtex(self):
@@ -82,29 +97,9 @@ class Article(dbobject, has_title_and_namespace):
     #                         " WHERE id = %i" % self.id)
     #     return source
 
-    @property
-    def bibtex_source(self):
-        source, = query_one("SELECT bibtex_source "
-                            "  FROM wiki.article WHERE id = %i" % self.id)
-        return source
-
-    @property
-    def user_info(self):
-        if not hasattr(self, "_user_info"):
-            self._user_info, = query_one(
-                "SELECT user_info "
-                "  FROM wiki.article WHERE id = %i" % self.id)
-        return self._user_info
-
-    @user_info.setter
-    def user_info(self, i):
-        self._user_info = i
-
-    @property
-    def user_info_source(self):
-        source, = query_one("SELECT user_info_source "
-                            "  FROM wiki.article WHERE id = %i" % self.id)
-        return source
+    bibtex_source = deferred()
+    user_info = deferred()
+    user_info_source = deferred()
 
 class ArticleForView(Article):
     __view__ = "article_for_view"
@@ -118,20 +113,25 @@ class ArticleForBibTeXRedo(Article):
 class ArticleForList(Article):
     __view__ = "article_for_list"
 
+included_articles_statement = Statement(
+    "included_articles",
+    lambda: get_sql_file_path("recursive_include_query.sql").read_text())
+
 class IncludedArticle(dbobject):
     # article_id, included_as
 
     @classmethod
     def query_recursively_for(IncludedArticle, article_id:int):
-        cursor = execute_with_template(
-            "recursive_include_query.sql", ( article_id, ))
+        cursor = included_articles_statement.execute( (article_id,) )
         return [ IncludedArticle(cursor.description, tpl)
                  for tpl in cursor.fetchall() ]
 
 class ResolvedArticleLink(dbobject, has_title_and_namespace):
+    __schema__ = "wiki"
     __view__ = "article_link_resolved"
 
 class ResolvedArticleTeaser(dbobject, has_title_and_namespace):
+    __schema__ = "wiki"
     __view__ = "article_teaser_on_resolved"
 
 class ArticleTitle(dbobject, has_title_and_namespace):
@@ -148,7 +148,8 @@ class ArticleTitle(dbobject, has_title_and_namespace):
 
     @classmethod
     def select_by_full_title(ArticleTitle, title):
-        return ArticleTitle.select_one(ArticleTitle.title_where(title))
+        return article_title_by_full_title_statement.select_one(
+            (title,), ArticleTitle)
 
     @property
     def language_object(self):
@@ -164,19 +165,60 @@ class Upload(dbobject):
 
     preview_sizes = ( 300, 600, 1800, )
 
-    @property
-    def data(self):
-        if hasattr(self, "_data"):
-            return self._data
-        else:
-            data, = query_one("SELECT data "
-                              "  FROM uploads.upload "
-                              " WHERE id = %i" % self.id)
-            return data
+    # Bytes read per query by iter_data().
+    chunk_size = 1024 * 1024
+
+    # The whole file. Use iter_data() for large ones.
+    data = deferred()
+
+    def iter_data(self, start=0, length=None, pool=None):
+        """
+        Return an iterator over the upload’s data from byte “start”,
+        “length” bytes or to the end, in chunks of Upload.chunk_size.
+        Each chunk is read with a short query on a connection borrowed
+        from “pool” (default: the application’s), so iterating slowly
+        keeps no connection busy. The upload must have been committed.
+        Uploads kept in the upload store are read from disk.
+        """
+        if length is None:
+            length = self.size - start
 
-    @data.setter
-    def data(self, _data):
-        self._data = _data
+        store = get_upload_store()
+        if store is not None and getattr(self, "sha256", None):
+            return store.iter_file(self.sha256, start, length,
+                                   self.chunk_size)
+
+        if pool is None:
+            pool = get_pool()
+
+        return self._iter_data(pool, self.id, start, length,
+                               self.chunk_size)
+
+    @staticmethod
+    def _iter_data(pool, id, start, length, chunk_size):
+        end = start + length
+        while start < end:
+            size = min(chunk_size, end - start)
+
+            dbconn = pool.getconn()
+            try:
+                with dbconn.cursor() as cc:
+                    # substring() counts from 1.
+                    cc.execute("SELECT substring(data FROM %s FOR %s) "
+                               "  FROM uploads.upload WHERE id = %s",
+                               ( start + 1, size, id, ))
+                    row = cc.fetchone()
+                dbconn.rollback()
+            finally:
+                pool.putconn(dbconn)
+
+            if row is None or not row[0]:
+                # Deleted meanwhile.
+                return
+
+            chunk = bytes(row[0])
+            yield chunk
+            start += len(chunk)
 
     @property
     def ext(self):
@@ -205,7 +247,13 @@ class Upload(dbobject):
 
     @property
     def preview_dir_name(self):
-        return "%i_%i_%s" % ( self.article_id, self.id, self.slug, )
+        """
+        Each preview version has its own directory, so a preview’s URL
+        always refers to the same image. Version 0 are the previews
+        made before they were versioned.
+        """
+        return preview_dir_name(self.article_id, self.id, self.slug,
+                                self.preview_version)
 
     def preview_url_for(self, size):
         assert size in self.preview_sizes, ValueError
@@ -3,11 +3,13 @@
 # to figure them out right now.
 
 import os, os.path as op, getpass, select, time, threading, logging, json
-import runpy
+import runpy, atexit
 import psycopg2
 
 from t4 import sql
 
+from .dbpool import ConnectionPool
+
 config_file = os.getenv("YOURAPPLICATION_SETTINGS",
                         os.getenv("BLGD_APPLICATION_SETTINGS", None))
 if config_file is None:
@@ -17,6 +19,29 @@ elif not op.exists(config_file):
 
 config = runpy.run_path(config_file)
 
+# Scripts and workers use the same pool class as the web application.
+# It is created on first use, so merely importing this module does not
+# connect to the database.
+_dbpool = None
+def get_pool():
+    global _dbpool
+    if _dbpool is None:
+        _dbpool = ConnectionPool.from_config(config)
+        atexit.register(_dbpool.closeall)
+    return _dbpool
+
+def close_pool():
+    """
+    Return the fake g’s connection and close the pool’s. Call this
+    before forking, so the child processes do not share connections
+    with us. A new pool is created on next use.
+    """
+    global _dbpool
+    flask.g.release_dbconn()
+    if _dbpool is not None:
+        _dbpool.closeall()
+        _dbpool = None
+
 class Worker:
     def __init__(self):
         self._dbconn = None
@@ -24,9 +49,18 @@ class Worker:
     @property
     def dbconn(self):
         if self._dbconn is None:
-            self._dbconn = psycopg2.connect(**config["DATASOURCE"])
+            self._dbconn = get_pool().getconn()
         return self._dbconn
 
+    def release_dbconn(self, close=False):
+        """
+        Return our connection to the pool. Pass close=True if it is
+        known to be broken.
+        """
+        if self._dbconn is not None:
+            get_pool().putconn(self._dbconn, close)
+            self._dbconn = None
+
     def cursor(self):
         return self.dbconn.cursor()
 
@@ -37,14 +71,15 @@ class NotificationWorker(Worker):
 
     @property
     def dbconn(self):
-        ret = super().dbconn
+        if self._dbconn is None:
+            ret = super().dbconn
 
-        cursor = ret.cursor()
-        logging.info("Starting to LISTEN to %s" % self.event_name)
-        cursor.execute("LISTEN %s;" % self.event_name)
-        ret.commit()
+            cursor = ret.cursor()
+            logging.info("Starting to LISTEN to %s" % self.event_name)
+            cursor.execute("LISTEN %s;" % self.event_name)
+            ret.commit()
 
-        return ret
+        return self._dbconn
 
     @property
     def event_name(self):
@@ -79,12 +114,12 @@ class NotificationWorker(Worker):
                         try:
                             self.on_notification()
                         except Exception as e:
-                            logger.info("Exception in work: " + repr(e))
+                            logging.info("Exception in work: " + repr(e))
 
             except ( psycopg2.DatabaseError,
                      psycopg2.OperationalError) as e:
-                self.log_traceback()
-                self._dbconn = None
+                logging.exception("Database error in %s" % self.event_name)
+                self.release_dbconn(close=True)
                 time.sleep(60)
 
 
@@ -93,6 +128,7 @@ class FakeGlobal(Worker):
     # it has db connection management.
 
     debug_sql = True
+    profile_sql = False
 
     def __contains__(self, name):
         return hasattr(self, name)
@@ -101,6 +137,10 @@ class FakeGlobal(Worker):
     def config(self):
         return config
 
+    @property
+    def dbpool(self):
+        return get_pool()
+
 
 
 # Import flask
@@ -0,0 +1,180 @@
+"""
+Garbage collection for PREVIEW_PATH.
+
+Deleting an upload or an article removes its rows, but not its preview
+dir. New preview versions leave the old dirs behind on purpose, for the
+pages and caches that still refer to them, and crashed renders may
+leave temporary dirs. collect_preview_garbage() reconciles the preview
+tree with uploads.upload and removes
+
+• preview dirs of uploads that no longer exist,
+• preview dirs of superseded preview versions,
+• temporary dirs left behind by render_previews_for() and
+• files in current preview dirs that are no preview, like the
+  grey.jpg and original.* files earlier versions left behind,
+
+as long as they have not been modified for “min_age” seconds. A
+superseded version dir is kept until its successor has existed that
+long, because it is the successor’s mtime that tells when pages
+started to refer to the new version. It does not use flask.g, so it
+may run in a worker thread with a connection of its own. Run
+bin/gc_previews or set PREVIEW_GC_INTERVAL for bin/preview_worker.
+"""
+
+import os, re, time, shutil, pathlib, logging
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+preview_dir_re = re.compile(r"^(\d+)_(\d+)_")
+preview_file_re = re.compile(r"^preview\d+\.[a-z]+$")
+
+def preview_dir_name(article_id, upload_id, slug, preview_version):
+    """
+    Return the name of an upload’s preview dir, which
+    Upload.preview_dir_name and preview_dir_re rely on.
+    """
+    ret = "%i_%i_%s" % ( article_id, upload_id, slug, )
+    if preview_version:
+        ret += "_v%i" % preview_version
+    return ret
+
+class GCReport(NamedTuple):
+    dirs: int
+    files: int
+    bytes: int
+
+class SpaceCounter(object):
+    """
+    Count the bytes that deleting files will free. Hard linked files
+    take no space until their last link is gone.
+    """
+    def __init__(self):
+        self.files = 0
+        self._inodes = {}
+
+    def add(self, path):
+        info = path.lstat()
+        self.files += 1
+
+        key = ( info.st_dev, info.st_ino, )
+        links, size, seen = self._inodes.get(key, ( info.st_nlink,
+                                                    info.st_blocks * 512,
+                                                    0, ))
+        self._inodes[key] = ( links, size, seen + 1, )
+
+    def add_tree(self, path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in filenames:
+                self.add(pathlib.Path(dirpath, filename))
+
+    @property
+    def bytes(self):
+        return sum([ size for (links, size, seen) in self._inodes.values()
+                     if seen >= links ])
+
+def _current_preview_dirs(dbconn, upload_ids):
+    """
+    Return a dict that maps the “upload_ids” that still exist to
+    their current preview dir name.
+    """
+    with dbconn.cursor() as cc:
+        cc.execute("SELECT id, article_id, slug, preview_version "
+                   "  FROM uploads.upload "
+                   " WHERE id = ANY(%s)", ( list(upload_ids), ))
+        ret = { id: preview_dir_name(article_id, id, slug, preview_version)
+                for id, article_id, slug, preview_version in cc.fetchall() }
+    dbconn.rollback()
+    return ret
+
+def collect_preview_garbage(dbconn, preview_path, dry_run=False,
+                            batch_size=500, min_age=86400, verbose=False):
+    """
+    Remove what does not belong into “preview_path” (see above),
+    looking up “batch_size” preview dirs in the database at a time.
+    With “dry_run”, only count it. Return a GCReport of the number of
+    dirs and files removed and the bytes reclaimed.
+    """
+    preview_path = pathlib.Path(preview_path)
+    cutoff = time.time() - min_age
+    counter = SpaceCounter()
+    garbage_dirs = []
+
+    def old_enough(path):
+        return path.lstat().st_mtime < cutoff
+
+    def remove_dir(path):
+        counter.add_tree(path)
+        garbage_dirs.append(path)
+        if verbose:
+            print("Removing", path)
+        if not dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def superseded_long_enough(current_path):
+        # The current dir is created when its version is first
+        # rendered, that is, after the old ones were superseded. Until
+        # it exists, old versions are all there is to show.
+        try:
+            return current_path.stat().st_mtime < cutoff
+        except FileNotFoundError:
+            return False
+
+    def collect(batch):
+        current = _current_preview_dirs(dbconn, batch.keys())
+        for upload_id, paths in batch.items():
+            current_name = current.get(upload_id)
+            if current_name is None:
+                # The upload is gone.
+                for path in paths:
+                    if old_enough(path):
+                        remove_dir(path)
+                continue
+
+            current_path = preview_path / current_name
+            for path in paths:
+                if path.name != current_name:
+                    if superseded_long_enough(current_path):
+                        remove_dir(path)
+                else:
+                    for file_path in path.iterdir():
+                        if file_path.is_file() \
+                           and not preview_file_re.match(file_path.name) \
+                           and old_enough(file_path):
+                            counter.add(file_path)
+                            if verbose:
+                                print("Removing", file_path)
+                            if not dry_run:
+                                file_path.unlink(missing_ok=True)
+
+    # Maps upload ids to their preview dirs, several for old versions.
+    batch = {}
+    for entry in os.scandir(preview_path):
+        path = pathlib.Path(entry.path)
+
+        if not entry.is_dir(follow_symlinks=False):
+            # The lock files of ensure_previews_for() and such.
+            continue
+
+        if entry.name.startswith("."):
+            # Temporary dirs of render_previews_for().
+            if old_enough(path):
+                remove_dir(path)
+            continue
+
+        match = preview_dir_re.match(entry.name)
+        if match is None:
+            continue
+
+        batch.setdefault(int(match.group(2)), []).append(path)
+        if len(batch) >= batch_size:
+            collect(batch)
+            batch = {}
+
+    if batch:
+        collect(batch)
+
+    report = GCReport(len(garbage_dirs), counter.files, counter.bytes)
+    logger.info("%s %i preview dirs and %i files, %i bytes.",
+                "Would remove" if dry_run else "Removed", *report)
+    return report
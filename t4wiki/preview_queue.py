@@ -0,0 +1,245 @@
+"""
+Background preview generation, for scripts only: This module imports
+plastic_bottle.
+
+If PREVIEW_QUEUE is set, files_form.cgi does not create previews
+itself. It calls previews.enqueue_preview_job(), which inserts a row
+into uploads.preview_job and makes a trigger NOTIFY “preview_job”.
+The PreviewWorker (run bin/preview_worker)
+wakes up, claims jobs with SELECT … FOR UPDATE SKIP LOCKED in
+PREVIEW_WORKERS threads and deletes them when the previews are done.
+Until then, upload_info.preview_pending is true and the user interface
+shows a placeholder. Jobs that fail PREVIEW_JOB_MAX_ATTEMPTS times are
+marked failed and no longer pending, so the fallback is shown.
+
+create_previews_for_all() (run bin/create_previews) brings the previews
+of all uploads up to date in a pool of processes.
+
+With PREVIEW_GC_INTERVAL set to a number of seconds, the PreviewWorker
+also runs preview_gc.collect_preview_garbage() that often.
+"""
+
+import time, threading, multiprocessing, concurrent.futures, logging
+
+from t4 import sql
+
+from . import model
+from .db import commit, rollup_sql
+from .plastic_bottle import NotificationWorker, get_pool, close_pool, config
+from .preview_gc import collect_preview_garbage
+from .previews import (render_previews_for, previews_complete,
+                       preview_dir_for, image_exts)
+
+logger = logging.getLogger(__name__)
+
+def process_next_job(dbconn, max_attempts=3):
+    """
+    Claim one job on “dbconn” and create the previews for it. Return
+    False if there was no job to claim. The job’s row stays locked
+    while we work on it, so if we crash, the job is retried. A job
+    that fails “max_attempts” times is marked failed and not tried
+    again until it is enqueued anew.
+    """
+    with dbconn.cursor() as cc:
+        cc.execute("SELECT upload_info.* "
+                   "  FROM uploads.preview_job "
+                   "  JOIN uploads.upload_info "
+                   "    ON upload_info.id = preview_job.upload_id "
+                   " WHERE NOT failed "
+                   " ORDER BY preview_job.ctime "
+                   "   FOR UPDATE OF preview_job SKIP LOCKED "
+                   " LIMIT 1")
+        row = cc.fetchone()
+        if row is None:
+            dbconn.rollback()
+            return False
+
+        upload = model.Upload(cc.description, row)
+
+    try:
+        data = render_previews_for(upload)
+    except Exception as exc:
+        logger.exception("Creating previews for upload %i failed.",
+                         upload.id)
+        with dbconn.cursor() as cc:
+            cc.execute("UPDATE uploads.preview_job "
+                       "   SET attempts = attempts + 1, last_error = %s, "
+                       "       failed = attempts + 1 >= %s "
+                       " WHERE upload_id = %s",
+                       ( repr(exc), max_attempts, upload.id, ))
+    else:
+        with dbconn.cursor() as cc:
+            command, params = rollup_sql(sql.update(
+                "uploads.upload", sql.where("id = %i" % upload.id), data))
+            cc.execute(command, params)
+            cc.execute("DELETE FROM uploads.preview_job "
+                       " WHERE upload_id = %s", ( upload.id, ))
+
+    dbconn.commit()
+    return True
+
+class PreviewWorker(NotificationWorker):
+    """
+    Wait for NOTIFY preview_job and process the queue in “parallelism”
+    threads, each with its own database connection. The job’s row stays
+    locked in that connection’s transaction, so reading upload data from
+    the database borrows a second one per thread.
+    """
+    event_name = "preview_job"
+
+    def __init__(self, parallelism=2, max_attempts=3, gc_interval=None):
+        super().__init__()
+        self.parallelism = parallelism
+        self.max_attempts = max_attempts
+        self._wakeup = threading.Condition()
+        self.threads = [ threading.Thread(target=self.work, daemon=True,
+                                          name="preview-worker-%i" % a)
+                         for a in range(parallelism) ]
+
+        if gc_interval:
+            self.gc_interval = gc_interval
+            self.threads.append(threading.Thread(target=self.collect_garbage,
+                                                 daemon=True,
+                                                 name="preview-gc"))
+
+    def run(self):
+        # Two connections per worker thread, the one we LISTEN on and
+        # the garbage collector’s.
+        needed = 2 * self.parallelism + 1
+        if hasattr(self, "gc_interval"):
+            needed += 1
+
+        pool = get_pool()
+        if pool.maxconn < needed:
+            raise ValueError("%i preview workers need DBPOOL_MAXCONN to be "
+                             "%i or more, it is %i." % (
+                                 self.parallelism, needed, pool.maxconn, ))
+
+        for thread in self.threads:
+            thread.start()
+        super().run()
+
+    def on_notification(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def work(self):
+        pool = get_pool()
+        while True:
+            dbconn = None
+            try:
+                dbconn = pool.getconn()
+                while process_next_job(dbconn, self.max_attempts):
+                    pass
+            except Exception:
+                # Keep the thread alive. The connection may be in any
+                # state, including holding a job’s lock.
+                logger.exception("Error in preview worker.")
+                if dbconn is not None:
+                    pool.putconn(dbconn, close=True)
+            else:
+                pool.putconn(dbconn)
+
+            # Look at the queue once a minute, in case we missed a
+            # notification while busy.
+            with self._wakeup:
+                self._wakeup.wait(60)
+
+    def collect_garbage(self):
+        pool = get_pool()
+        while True:
+            time.sleep(self.gc_interval)
+
+            dbconn = None
+            try:
+                dbconn = pool.getconn()
+                collect_preview_garbage(
+                    dbconn, config["PREVIEW_PATH"],
+                    min_age=config.get("PREVIEW_GC_MIN_AGE", 86400))
+            except Exception:
+                logger.exception("Preview garbage collection failed.")
+                if dbconn is not None:
+                    pool.putconn(dbconn, close=True)
+            else:
+                pool.putconn(dbconn)
+
+def needs_previews(upload):
+    """
+    Return whether the previews of “upload” are missing, incomplete or
+    older than the upload, or its dimensions have not been stored.
+    """
+    if not previews_complete(upload):
+        return True
+
+    return upload.ext in image_exts and upload.ext != ".pdf" \
+        and upload.width is None
+
+def _render(info):
+    # Runs in the process pool. Upload objects can’t be pickled, so we
+    # get their as_dict().
+    upload = model.Upload.from_dict(info)
+    try:
+        data = render_previews_for(upload)
+    except Exception as exc:
+        logger.exception("Creating previews for upload %i failed.",
+                         upload.id)
+        return upload.id, None, repr(exc)
+    else:
+        data["preview_version"] = upload.preview_version
+        return upload.id, data, None
+
+def _job_for(upload):
+    info = upload.as_dict()
+
+    # Previews that exist may be cached by browsers and proxies. New
+    # ones need a new version and URL.
+    if preview_dir_for(upload).exists():
+        info["preview_version"] = upload.preview_version + 1
+
+    return info
+
+def create_previews_for_all(jobs=1, batch_size=50, force=False,
+                            verbose=False):
+    """
+    Create the previews for all uploads that need_previews() (all of
+    them with “force”) in “jobs” processes. Dimensions and preview
+    versions are committed every “batch_size” uploads. Preview dirs
+    are complete or missing, so this may be interrupted and run again:
+    It will pick up where it left off. Return the number of uploads
+    processed and the number of failures.
+    """
+    todo = [ _job_for(upload)
+             for upload in model.Upload.select_streaming()
+             if force or needs_previews(upload) ]
+    commit()
+
+    if jobs > 1:
+        # The children open connections of their own if they need to
+        # read upload data from the database.
+        close_pool()
+        executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, mp_context=multiprocessing.get_context("fork"))
+        results = executor.map(_render, todo)
+    else:
+        executor = None
+        results = map(_render, todo)
+
+    failed = 0
+    try:
+        for count, (id, data, error) in enumerate(results, 1):
+            if error is not None:
+                failed += 1
+            else:
+                model.Upload.update_db(id, **data)
+
+            if verbose:
+                print(id, error or data)
+
+            if count % batch_size == 0:
+                commit()
+        commit()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return len(todo), failed
@@ -0,0 +1,315 @@
+"""
+Creating the preview images shown for uploads.
+"""
+
+import io, pathlib, subprocess, shutil, tempfile, datetime, fcntl, logging
+from PIL import Image
+
+from flask import current_app as app
+
+from . import model
+from .db import execute
+from .upload_store import get_upload_store
+
+logger = logging.getLogger(__name__)
+
+# Uploads we can make real previews of.
+image_exts = { ".jpg", ".png", ".pdf", ".webp", }
+
+def make_grey_image(greypath):
+    img = Image.new(mode="L", size=(200,200), color=128)
+    img.save(greypath)
+
+def avif_enabled():
+    """
+    AVIF previews are made next to the WebP ones unless PREVIEW_AVIF
+    is false or Pillow can’t write AVIF.
+    """
+    return app.config.get("PREVIEW_AVIF", True) \
+        and ".avif" in Image.registered_extensions()
+
+def avif_for(upload:model.Upload):
+    return upload.ext in image_exts \
+        and preview_ext_for(upload.ext) == ".webp" \
+        and avif_enabled()
+
+def preview_paths_for(preview_dir, upload:model.Upload):
+    """
+    Return the paths of the preview files for “upload” in “preview_dir”.
+    """
+    if upload.ext in image_exts:
+        exts = [ preview_ext_for(upload.ext), ]
+        if avif_for(upload):
+            exts.append(".avif")
+    else:
+        exts = [ ".jpg", ]
+
+    return [ pathlib.Path(preview_dir, "preview%i%s" % ( size, ext, ))
+             for ext in exts
+             for size in model.Upload.preview_sizes ]
+
+def preview_dir_for(upload:model.Upload):
+    return pathlib.Path(app.config["PREVIEW_PATH"], upload.preview_dir_name)
+
+def previews_complete(upload:model.Upload):
+    """
+    Return whether all of “upload”’s preview files exist and were made
+    after it was uploaded.
+    """
+    preview_dir = preview_dir_for(upload)
+    try:
+        mtime = preview_dir.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+    # upload.ctime is local time, like fromtimestamp()’s.
+    if upload.ctime is not None and \
+       datetime.datetime.fromtimestamp(mtime) < upload.ctime:
+        return False
+
+    return all([ path.exists()
+                 for path in preview_paths_for(preview_dir, upload) ])
+
+def render_previews_for(upload:model.Upload):
+    """
+    Create the preview files for “upload” in its preview dir. Return
+    a dict of the upload’s columns to update: “preview_avif” and the
+    image’s “width” and “height” if they were determined. Does not
+    touch the database, except for reading the upload’s data.
+
+    The previews are made in a temporary directory, which replaces the
+    preview dir when done. So a preview dir is always complete, even if
+    we crash while rendering.
+    """
+    preview_path = pathlib.Path(app.config["PREVIEW_PATH"])
+    preview_dir = pathlib.Path(preview_path, upload.preview_dir_name)
+    tmp_dir = pathlib.Path(tempfile.mkdtemp(
+        dir=preview_path, prefix="." + upload.preview_dir_name + "."))
+
+    avif = avif_for(upload)
+    try:
+        if upload.ext in image_exts:
+            dimensions = create_image_previews_for(tmp_dir, upload, avif)
+        else:
+            # Create default grey images.
+            greypath = pathlib.Path(tmp_dir, "grey.jpg")
+            make_grey_image(greypath)
+            for outfilepath in preview_paths_for(tmp_dir, upload):
+                outfilepath.hardlink_to(greypath)
+            greypath.unlink()
+            dimensions = None
+
+        # mkdtemp() creates directories only we may read.
+        tmp_dir.chmod(0o755)
+
+        if preview_dir.exists():
+            old_dir = tmp_dir.with_name(tmp_dir.name + ".old")
+            preview_dir.rename(old_dir)
+            tmp_dir.rename(preview_dir)
+            shutil.rmtree(old_dir)
+        else:
+            tmp_dir.rename(preview_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    ret = { "preview_avif": avif, }
+    if dimensions is not None:
+        ret["width"], ret["height"] = dimensions
+    return ret
+
+def create_previews_for(upload:model.Upload, new_version=False):
+    """
+    Create “upload”’s previews and store its dimensions. With
+    “new_version”, they go into a new preview dir with a new URL,
+    rather than replacing the current ones.
+    """
+    if new_version:
+        upload.preview_version = upload.preview_version + 1
+
+    data = render_previews_for(upload)
+
+    if new_version:
+        data["preview_version"] = upload.preview_version
+    upload.update_db(**data)
+
+# Number of lock files ensure_previews_for() spreads uploads over.
+preview_lock_count = 64
+
+def ensure_previews_for(upload:model.Upload):
+    """
+    Create “upload”’s previews unless they are complete. Concurrent
+    calls for the same upload, in this process or others, wait for the
+    first one to finish instead of rendering them again. Return True
+    if we created the previews, in which case the upload’s dimensions
+    have been updated and need to be committed.
+    """
+    lock_path = pathlib.Path(app.config["PREVIEW_PATH"],
+                             ".lock%02i" % ( upload.id % preview_lock_count, ))
+    with lock_path.open("a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            if previews_complete(upload):
+                return False
+
+            create_previews_for(upload)
+            return True
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+def link_or_copy(source, target):
+    try:
+        target.hardlink_to(source)
+    except OSError:
+        # Different file systems.
+        shutil.copyfile(source, target)
+
+class PreviewTooLarge(Exception): pass
+
+# Decoded pixels are held in memory up to this many bytes per job.
+default_memory_limit = 512 * 1024 * 1024
+
+def preview_ext_for(ext):
+    if ext in (".pdf", ".jpg",):
+        return ".webp"
+    else:
+        return ext
+
+def rasterize_pdf(path, size, memory_limit):
+    """
+    Render the first page of the PDF at “path” to fit into a square of
+    “size” pixels in a single ImageMagick process whose address space
+    is limited, and return it as PIL image.
+    """
+    # Limit the address space of convert and the Ghostscript it runs
+    # through the shell, since preexec_fn is not safe with threads.
+    limit_kib = ( memory_limit + 256 * 1024 * 1024 ) // 1024 # + code
+    cmd = [ "sh", "-c", 'ulimit -v %i && exec "$0" "$@"' % limit_kib,
+            "convert",
+            "-limit", "memory", str(memory_limit),
+            "-limit", "map", str(memory_limit),
+            "-density", "160", # A4 at 160 dpi is taller than 1800px.
+            "pdf:" + str(path) + "[0]",
+            "-thumbnail", "%ix%i>" % ( size, size, ),
+            "png:-" ]
+    done = subprocess.run(cmd, capture_output=True)
+    if done.returncode != 0:
+        raise OSError("convert failed: " +
+                      done.stderr.decode("utf-8", errors="replace"))
+
+    image = Image.open(io.BytesIO(done.stdout))
+    image.load()
+    return image
+
+def decode_image(path, size, memory_limit):
+    """
+    Decode the image at “path” once, with JPEGs scaled down by the
+    decoder as far as possible while still being larger than “size”.
+    The header is checked first: Images that would take more than
+    “memory_limit” bytes decoded raise PreviewTooLarge.
+    """
+    image = Image.open(path) # Only reads the header.
+    if image.format == "JPEG":
+        image.draft("RGB", ( size, size, ))
+
+    width, height = image.size
+    if width * height * len(image.getbands()) > memory_limit:
+        raise PreviewTooLarge("%s is %i×%i pixels." % ( path, width, height, ))
+
+    image.load()
+    return image
+
+def make_previews(original_path, ext, preview_dir,
+                  sizes=model.Upload.preview_sizes,
+                  memory_limit=default_memory_limit, avif=False):
+    """
+    Create preview<size><preview ext> files in “preview_dir” from the
+    image or PDF at “original_path”, and preview<size>.avif files, too,
+    with “avif” if the preview ext is .webp. The original is decoded
+    (or the PDF rasterized) once, at the largest size needed, and each
+    smaller preview is scaled down from the previous one. Return the
+    original image’s ( width, height, ), or None for PDFs.
+    """
+    preview_ext = preview_ext_for(ext)
+    avif = avif and preview_ext == ".webp"
+    sizes = sorted(sizes, reverse=True)
+
+    if ext == ".pdf":
+        image = rasterize_pdf(original_path, sizes[0], memory_limit)
+        dimensions = None
+    else:
+        with Image.open(original_path) as header:
+            dimensions = header.size
+        image = decode_image(original_path, sizes[0], memory_limit)
+
+    if image.mode not in { "RGB", "RGBA", "L", "LA", }:
+        if "A" in image.getbands() or "transparency" in image.info:
+            image = image.convert("RGBA")
+        else:
+            image = image.convert("RGB")
+
+    for size in sizes:
+        outfilepath = pathlib.Path(preview_dir,
+                                   "preview%i%s" % ( size, preview_ext, ))
+
+        # Does nothing to images that are smaller already.
+        image.thumbnail( ( size, size, ), Image.LANCZOS, reducing_gap=2.0)
+
+        if dimensions is not None and preview_ext == ext \
+           and dimensions[0] < size and dimensions[1] < size:
+            # No point in making this preview.
+            link_or_copy(original_path, outfilepath)
+        else:
+            image.save(outfilepath)
+
+        if avif:
+            image.save(pathlib.Path(preview_dir, "preview%i.avif" % size))
+
+    return dimensions
+
+def create_image_previews_for(preview_dir, upload, avif=False):
+    store = get_upload_store()
+    if store is not None and getattr(upload, "sha256", None):
+        # Read the original straight from the store.
+        original_path = store.path_for(upload.sha256)
+        temporary_original = False
+    else:
+        original_path = pathlib.Path(preview_dir, "original" + upload.ext)
+        temporary_original = True
+        with original_path.open("wb") as fp:
+            if "data" in upload.__dict__:
+                # Just uploaded and not committed yet.
+                fp.write(upload.data)
+            else:
+                for chunk in upload.iter_data():
+                    fp.write(chunk)
+
+    try:
+        dimensions = make_previews(
+            original_path, upload.ext, preview_dir,
+            memory_limit=app.config.get("PREVIEW_MEMORY_LIMIT",
+                                        default_memory_limit),
+            avif=avif)
+    except (OSError, PreviewTooLarge, Image.DecompressionBombError) as exc:
+        logger.warning("Can’t create previews for upload %i: %s",
+                       upload.id, exc)
+        dimensions = None
+        for outfilepath in preview_paths_for(preview_dir, upload):
+            outfilepath.unlink(missing_ok=True)
+            make_grey_image(outfilepath)
+    finally:
+        if temporary_original:
+            original_path.unlink()
+
+    return dimensions
+
+def enqueue_preview_job(upload_id):
+    """
+    Have bin/preview_worker create the previews for “upload_id” once
+    the current transaction is committed. See preview_queue.
+    """
+    execute("INSERT INTO uploads.preview_job (upload_id) VALUES (%s) "
+            "    ON CONFLICT (upload_id) DO UPDATE "
+            "   SET ctime = NOW(), attempts = 0, last_error = NULL, "
+            "       failed = false",
+            ( upload_id, ))
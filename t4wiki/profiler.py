@@ -0,0 +1,189 @@
+"""
+Per-request SQL profiling.
+
+When app.profile_sql is set (PROFILE_SQL in the environment or the
+config), db.cursor() wraps each cursor in a ProfilingCursorWrapper that
+records every statement executed for the current request. At the end of
+the request the timings are sent to the browser in a Server-Timing
+header, repeated statements (N+1 patterns) are logged and the slowest
+requests are kept for the /wiki/sql_profile page. With profiling off
+db.cursor() pays for one attribute lookup.
+"""
+
+import sys, os.path as op, re, time, threading, heapq, collections
+from typing import NamedTuple
+
+from flask import g, current_app as app, request
+
+class ProfileEntry(NamedTuple):
+    normalized: str
+    seconds: float
+    rowcount: int
+    call_site: str
+
+string_literal_re = re.compile(r"'(?:[^']|'')*'")
+number_re = re.compile(r"\b\d+(?:\.\d+)?\b")
+value_list_re = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+whitespace_re = re.compile(r"\s+")
+def normalize_sql(command):
+    """
+    Replace literals with “?” and collapse whitespace so statements that
+    differ only in their parameters compare equal.
+    """
+    if isinstance(command, bytes):
+        command = command.decode("utf-8", errors="replace")
+
+    command = string_literal_re.sub("?", command)
+    command = number_re.sub("?", command)
+    command = value_list_re.sub("(…)", command)
+    return whitespace_re.sub(" ", command).strip()
+
+# Frames from these files are skipped when looking for the call site.
+_here = op.dirname(op.abspath(__file__))
+_internal_files = { op.join(_here, "db.py"), op.join(_here, "profiler.py"), }
+def find_call_site():
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename not in _internal_files:
+            return "%s:%i (%s)" % ( op.basename(filename),
+                                    frame.f_lineno,
+                                    frame.f_code.co_name, )
+        frame = frame.f_back
+    return "?"
+
+class RequestProfile(object):
+    def __init__(self, path):
+        self.path = path
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.entries = []
+
+    def record(self, command, seconds, rowcount):
+        self.entries.append(ProfileEntry(normalize_sql(command),
+                                         seconds, rowcount,
+                                         find_call_site()))
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.start
+
+    @property
+    def db_seconds(self):
+        return sum([ entry.seconds for entry in self.entries ])
+
+    def repeated(self, threshold):
+        """
+        Return ( normalized statement, count, ) tuples for statements
+        run at least “threshold” times, most frequent first.
+        """
+        counter = collections.Counter([ entry.normalized
+                                        for entry in self.entries ])
+        return [ (statement, count,)
+                 for statement, count in counter.most_common()
+                 if count >= threshold ]
+
+    def slowest_entries(self, n=10):
+        return sorted(self.entries, key=lambda e: e.seconds,
+                      reverse=True)[:n]
+
+    def server_timing(self, threshold):
+        ret = [ 'db;dur=%.2f;desc="%i statements"' % (
+            self.db_seconds * 1000, len(self.entries),) ]
+        if self.seconds is not None:
+            ret.append("app;dur=%.2f" % (self.seconds * 1000))
+
+        for idx, (statement, count) in enumerate(
+                self.repeated(threshold)[:3]):
+            # Header values must not contain quotes or non-ASCII.
+            desc = "%ix %s" % ( count, statement[:80], )
+            desc = desc.encode("ascii", errors="replace").decode("ascii")
+            desc = desc.replace('"', "'").replace("\\", "/")
+            ret.append('db-repeated-%i;desc="%s"' % ( idx, desc, ))
+
+        return ", ".join(ret)
+
+class ProfilingCursorWrapper(object):
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name in ( "_cursor", "_profile", ):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, vars)
+        finally:
+            self._profile.record(query, time.perf_counter() - start,
+                                 self._cursor.rowcount)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self._cursor.__exit__(type, value, traceback)
+
+    def __iter__(self):
+        return self._cursor.__iter__()
+
+class SlowestRequests(object):
+    """
+    Keep the “size” requests that spent the most time in the database,
+    for this process.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._heap = []
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        with self._lock:
+            # The counter breaks ties without comparing profiles.
+            self._counter += 1
+            item = ( profile.db_seconds, self._counter, profile, )
+            if len(self._heap) < self.size:
+                heapq.heappush(self._heap, item)
+            else:
+                heapq.heappushpop(self._heap, item)
+
+    def profiles(self):
+        with self._lock:
+            return [ profile for (seconds, counter, profile)
+                     in sorted(self._heap, reverse=True) ]
+
+def before_request():
+    g.sql_profile = RequestProfile(request.path)
+
+def after_request(response):
+    profile = g.pop("sql_profile", None)
+    if profile is None:
+        return response
+
+    profile.finish()
+
+    threshold = app.config.get("PROFILE_SQL_REPEAT_THRESHOLD", 3)
+    response.headers["Server-Timing"] = profile.server_timing(threshold)
+
+    for statement, count in profile.repeated(threshold):
+        app.logger.warning("%s ran %i times for %s",
+                           statement, count, profile.path)
+
+    app.sql_profiler_slowest.add(profile)
+
+    return response
+
+def init_app(app):
+    if getattr(app, "sql_profiler_slowest", None) is None:
+        app.sql_profiler_slowest = SlowestRequests(
+            app.config.get("PROFILE_SQL_SLOWEST_REQUESTS", 50))
+        app.before_request(before_request)
+        app.after_request(after_request)
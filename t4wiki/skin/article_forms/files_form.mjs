@@ -28,39 +28,23 @@ class FormControlManager
 
     notify_server()
     {
-        const self = this,
-              script_url = `${globalThis.site_url}/articles/modify_upload.cgi`;
-
-        var data = new FormData();
-        data.append("article_id", this.parent.parent.article_id);
-        data.append("upload_id", this.parent.upload_id);
-        data.append("name", this.name);
-        data.append("value", this.value);
-
-        fetch(script_url, {
-            "method": "POST",
-            body: data
-        }).then( function(response) {
-            if (response.ok)
-            {
-                self.element.classList.remove("is-invalid");
-                self.element.classList.add("is-valid");
-            }
-            else
-            {
-                self.element.classList.remove("is-valid");
-                self.element.classList.add("is-invalid");
-
+        // The FileFormManager sends our change with others.
+        this.parent.parent.queue_change(this);
+    }
 
-                response.text().then( text => { alert(text) });
-            }
-        });
+    set_valid(valid)
+    {
+        this.element.classList.toggle("is-valid", valid);
+        this.element.classList.toggle("is-invalid", !valid);
     }
 }
 
 class CheckboxManager extends FormControlManager
 {
-    // pass
+    get value()
+    {
+        return this.element.checked;
+    }
 }
 
 class TextInputManager extends FormControlManager
@@ -145,8 +129,119 @@ class FileFormManager
             function(element) {
                 self.upload_managers.push(new UploadManager(self, element));
             });
+
+        // Changes not sent yet by upload id and field name and the
+        // order of the uploads, if they have been reordered.
+        this.pending = new Map();
+        this.order = null;
+        this.timeout = null;
+
+        // Without JavaScript, the link goes to update_sortranks.cgi.
+        this.root_element.querySelectorAll("a.renumber-sortranks").forEach(
+            link => link.addEventListener("click", event => {
+                event.preventDefault();
+                this.renumber_sortranks();
+            }));
+
+        // Don’t lose changes when the user leaves the page.
+        window.addEventListener("pagehide", event => {
+            if (this.pending.size > 0 || this.order)
+            {
+                navigator.sendBeacon(this.script_url, new Blob(
+                    [ JSON.stringify(this.request_data()) ],
+                    { type: "application/json" }));
+            }
+        });
+    }
+
+    get script_url()
+    {
+        return `${globalThis.site_url}/articles/modify_uploads.cgi`;
+    }
+
+    // Send changes made within a short time of each other to the
+    // server in one request and transaction.
+    queue_change(control)
+    {
+        this.pending.set(`${control.parent.upload_id}:${control.name}`,
+                         control);
+        this.schedule_send();
     }
 
+    schedule_send()
+    {
+        if (this.timeout)
+        {
+            clearTimeout(this.timeout);
+        }
+        this.timeout = setTimeout(this.send_changes.bind(this), 300);
+    }
+
+    // Sort the uploads by their sort rank, like update_sortranks.cgi,
+    // number them 1, 2, … and have the server do the same.
+    renumber_sortranks()
+    {
+        const rank = manager => parseFloat(manager.sortrank_manager.value);
+
+        this.upload_managers.sort(
+            (a, b) => (rank(a) - rank(b)) || (a.upload_id - b.upload_id));
+
+        this.upload_managers.forEach((manager, index) => {
+            const input = manager.sortrank_manager;
+            input.element.value = (index + 1).toFixed(2);
+            input.original_value = input.value;
+
+            // Move the upload before the row holding the link.
+            this.root_element.insertBefore(
+                manager.element, this.root_element.lastElementChild);
+        });
+
+        this.order = this.upload_managers.map(
+            manager => manager.upload_id);
+        this.schedule_send();
+    }
+
+    request_data()
+    {
+        const controls = Array.from(this.pending.values()),
+              data = { article_id: this.article_id,
+                       changes: controls.map(
+                           control => [ control.parent.upload_id,
+                                        control.name,
+                                        control.value ]) };
+
+        if (this.order)
+        {
+            data.order = this.order;
+        }
+
+        this.pending.clear();
+        this.order = null;
+
+        return data;
+    }
+
+    send_changes()
+    {
+        this.timeout = null;
+
+        const controls = Array.from(this.pending.values()),
+              data = this.request_data();
+
+        fetch(this.script_url, {
+            "method": "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify(data)
+        }).then( function(response) {
+            // The changes are applied all together or not at all.
+            controls.forEach(control => control.set_valid(response.ok));
+
+            if (!response.ok)
+            {
+                response.text().then( text => { alert(text) });
+            }
+        });
+    }
 }
 
 export { FileFormManager };
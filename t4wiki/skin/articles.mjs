@@ -1,4 +1,4 @@
-import { title2path, normalize_whitespace } from "t4wiki";
+import { title2path, normalize_whitespace, await_preview } from "t4wiki";
 import { html } from "xisty";
 
 class Heading
@@ -449,6 +449,9 @@ function set_fileicon_class(icon_dom, ext)
 
 
 const illegal_filename_char_re = /\s+|\./i;
+
+// Like model.Upload.preview_sizes.
+const preview_sizes = [ 300, 600, 1800 ];
 class FileInfoByFilename
 {
 	constructor(info)
@@ -542,15 +545,29 @@ class FileManager
 
                 const id = fileinfo["id"], slug = fileinfo["slug"],
                       preview_ext = fileinfo["pext"],
-                      preview_dir = `${article_id}_${id}_${slug}`;
-                
-                img["src"] = `${globalThis.site_url}/previews/` +
-                    `${preview_dir}/preview${size}${preview_ext}`;
+                      version = fileinfo["pv"] ? `_v${fileinfo["pv"]}` : "",
+                      preview_dir = `${article_id}_${id}_${slug}${version}`,
+					  base = `${globalThis.site_url}/previews/` +
+					      `${preview_dir}/preview`,
+					  figure = img.closest("figure");
+
+				// Must be set before src to have an effect.
+				img.loading = "lazy";
+
+				if (fileinfo["pp"])
+				{
+					await_preview(img);
+				}
+				else
+				{
+					this.set_srcset(img, fileinfo, base, size);
+				}
 
-				if (img.parentNode.tagName == "FIGURE")
+                img["src"] = `${base}${size}${preview_ext}`;
+
+				if (figure)
 				{
-					const caption = img.parentNode.querySelector(
-						"figcaption");
+					const caption = figure.querySelector("figcaption");
 					if (caption && caption.textContent == "")
 					{
 						caption.textContent = fileinfo.title;
@@ -564,6 +581,57 @@ class FileManager
         }
     }
 
+	// Let the browser choose among the preview sizes by its screen’s
+	// resolution and prefer AVIF over WebP if it can. “size” is the
+	// preview the image is displayed at. With its width and height
+	// known, the browser reserves space for the image before it loads.
+	set_srcset(img, fileinfo, base, size)
+	{
+		const w = fileinfo["w"], h = fileinfo["h"];
+		if ( !w || !h )
+		{
+			// PDFs and images whose size could not be determined.
+			return;
+		}
+
+		function preview_width(size)
+		{
+			return Math.round(w * Math.min(1, size / Math.max(w, h)));
+		}
+
+		// Previews of small images may all have the same width.
+		const widths = {};
+		for (const size of preview_sizes)
+		{
+			widths[preview_width(size)] = size;
+		}
+
+		function srcset(ext)
+		{
+			return Object.entries(widths).map(
+				([width, size]) => `${base}${size}${ext} ${width}w`).join(
+					", ");
+		}
+
+		const width = preview_width(size);
+		img.width = width;
+		img.height = Math.round(h * width / w);
+		img.sizes = `(max-width: ${width}px) 100vw, ${width}px`;
+		img.srcset = srcset(fileinfo["pext"]);
+
+		if (fileinfo["pa"] && img.parentNode.tagName != "PICTURE")
+		{
+			const picture = document.createElement("picture"),
+				  source = document.createElement("source");
+			source.type = "image/avif";
+			source.srcset = srcset(".avif");
+			source.sizes = img.sizes;
+
+			img.replaceWith(picture);
+			picture.append(source, img);
+		}
+	}
+
 	handle_downloads(article_div, article_id, fileinfos)
 	{
 		if (fileinfos.download_count > 0)
@@ -9,7 +9,39 @@ export function normalize_whitespace(s)
 	return s.trim().replace(white_space_re, " ");
 }
 
+// Previews may be created in the background (see preview_queue.py).
+// Until they exist, reload the <img> every few seconds.
+export function await_preview(img, tries = 100)
+{
+	function retry()
+	{
+		if (tries-- > 0)
+		{
+			setTimeout(() => {
+				const url = new URL(img.src, window.location.href);
+				url.searchParams.set("retry", Date.now());
+				img.src = url.toString();
+			}, 3000);
+		}
+	}
+
+	img.classList.add("preview-pending");
+	img.addEventListener("error", retry);
+	img.addEventListener("load", event => {
+		img.classList.remove("preview-pending");
+	});
+
+	// It may have failed before we got here.
+	if (img.complete && img.getAttribute("src") && img.naturalWidth == 0)
+	{
+		retry();
+	}
+}
+
 document.addEventListener("DOMContentLoaded", function(event) {
+	document.querySelectorAll("img.preview-pending").forEach(
+		img => await_preview(img));
+
 	// Form tools
     function id_to_name(element)
     {
@@ -0,0 +1,140 @@
+"""
+Content addressed storage for uploads.
+
+If UPLOAD_STORE_PATH is configured, uploaded files are kept on disk
+rather than in uploads.upload.data. Each file is named by the SHA-256
+of its content, as <UPLOAD_STORE_PATH>/ab/cd/abcd…, and the upload row
+only keeps the hash and size. The same file attached to several
+articles is stored once. Files are written to a temporary file and
+renamed into place, so a file that exists is always complete. Stored
+files are never modified.
+"""
+
+import os, hashlib, tempfile, pathlib
+
+from flask import current_app as app
+
+class UploadStore(object):
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    def path_for(self, sha256):
+        return pathlib.Path(self.path, sha256[:2], sha256[2:4], sha256)
+
+    def exists(self, sha256):
+        return self.path_for(sha256).exists()
+
+    def put_chunks(self, chunks):
+        """
+        Store the bytes yielded by the “chunks” iterable. Return a pair
+        of the content’s SHA-256 as hex string and its size.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        hash = hashlib.sha256()
+        size = 0
+
+        fd, tmppath = tempfile.mkstemp(dir=self.path, prefix=".incoming-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                for chunk in chunks:
+                    hash.update(chunk)
+                    size += len(chunk)
+                    fp.write(chunk)
+
+                fp.flush()
+                os.fsync(fp.fileno())
+
+            sha256 = hash.hexdigest()
+            target = self.path_for(sha256)
+            if target.exists():
+                # We have that one already.
+                os.unlink(tmppath)
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.chmod(tmppath, 0o644)
+                os.replace(tmppath, target)
+        except BaseException:
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            raise
+
+        return sha256, size
+
+    def put_file(self, fp, chunk_size=1024*1024):
+        return self.put_chunks(iter(lambda: fp.read(chunk_size), b""))
+
+    def put(self, data:bytes):
+        return self.put_chunks([ data, ])
+
+    def iter_file(self, sha256, start=0, length=None, chunk_size=1024*1024):
+        """
+        Yield the stored file’s content from byte “start”, “length”
+        bytes or to the end, “chunk_size” bytes at a time.
+        """
+        with self.path_for(sha256).open("rb") as fp:
+            fp.seek(start)
+            while length is None or length > 0:
+                if length is None:
+                    chunk = fp.read(chunk_size)
+                else:
+                    chunk = fp.read(min(chunk_size, length))
+                    length -= len(chunk)
+
+                if not chunk:
+                    break
+
+                yield chunk
+
+_stores = {}
+def get_upload_store():
+    """
+    Return the UploadStore configured as UPLOAD_STORE_PATH or None if
+    uploads are kept in the database.
+    """
+    path = app.config.get("UPLOAD_STORE_PATH")
+    if not path:
+        return None
+
+    if path not in _stores:
+        _stores[path] = UploadStore(path)
+
+    return _stores[path]
+
+def move_blobs_to_store(store, batch_size=50, verbose=False):
+    """
+    Move upload data from the database into “store”, committing after
+    each batch of “batch_size” uploads. Uploads already moved are
+    skipped, so this may be interrupted and run again. The data is
+    read in chunks of Upload.chunk_size, so large files are never
+    held in memory as a whole.
+    """
+    from . import db
+    from .model import Upload
+
+    moved = 0
+    while True:
+        rows = db.execute(
+            "SELECT id, COALESCE(octet_length(data), 0) "
+            "  FROM uploads.upload "
+            " WHERE sha256 IS NULL "
+            " ORDER BY id LIMIT %s", ( batch_size, )).fetchall()
+
+        if not rows:
+            break
+
+        for id, length in rows:
+            sha256, size = store.put_chunks(Upload._iter_data(
+                db.get_pool(), id, 0, length, Upload.chunk_size))
+
+            db.execute("UPDATE uploads.upload "
+                       "   SET sha256 = %s, size = %s, data = NULL "
+                       " WHERE id = %s", ( sha256, size, id, ))
+
+            if verbose:
+                print(id, sha256, size)
+
+        db.commit()
+        moved += len(rows)
+
+    return moved
@@ -22,6 +22,7 @@ from . import markup
 from . import model
 from . import db
 from . import ptutils
+from . import profiler
 
 
 
@@ -45,6 +46,12 @@ class Blueprint(Blueprint):
         super().register(app, options)
 
         app.debug_sql = app.debug and (os.getenv("DEBUG_SQL") is not None)
+        app.profile_sql = ( os.getenv("PROFILE_SQL") is not None
+                            or app.config.get("PROFILE_SQL", False) )
+        db.init_app(app)
+
+        if app.profile_sql:
+            profiler.init_app(app)
 
 bp = Blueprint("wiki", __name__, url_prefix="/wiki")
 
@@ -62,6 +69,7 @@ def template_globals():
             }
 
 @bp.route("/t4wiki_languages.css")
+@db.read_only
 @login_required
 def languages_css():
     ret = []
@@ -81,25 +89,58 @@ def languages_css():
     return response
 
 
-create_query_view = '''\
-set search_path = wiki, public;
-
-CREATE TEMPORARY VIEW the_query AS
-    SELECT {} AS query;
-'''
-
-create_result_view = '''\
-set search_path = wiki, public;
-
-CREATE TEMPORARY VIEW search_result AS
-    SELECT id AS article_id,
-           ts_rank_cd('{0.1, 0.2, 0.4, 1.0}', tsvector, query, 0) AS rank,
-           ts_headline(current_html, query) AS headline
-      FROM article, the_query
-     WHERE tsvector @@ query;
-'''
-
-def full_text_search(query, *clauses, lang=None):
+@bp.route("/sql_profile")
+@role_required("Manager")
+def sql_profile():
+    """
+    List the requests that spent the most time in the database since
+    this process started, with their slowest and repeated statements.
+    """
+    if not app.profile_sql:
+        abort(404)
+
+    template = app.skin.load_template("sql_profile.pt")
+    threshold = app.config.get("PROFILE_SQL_REPEAT_THRESHOLD", 3)
+    return template(profiles=app.sql_profiler_slowest.profiles(),
+                    threshold=threshold,
+                    statements=db.statement_statistics())
+
+
+# Search queries are plain SELECTs without temporary views, so they
+# may run on a read-only standby. The search terms come as two arrays,
+# text search configurations and queries, OR-ed together by
+# tsquery_or_agg() (see sql/99_add_tsquery_or_agg.sql), so one prepared
+# statement serves any number of languages and titles. A NULL
+# namespace or limit means “any”.
+search_statement = db.Statement(
+    "full_text_search",
+    "WITH the_query AS ("
+    "    SELECT tsquery_or_agg(websearch_to_tsquery("
+    "               config::regconfig, terms)) AS query"
+    "      FROM unnest(%s::TEXT[], %s::TEXT[]) AS queries(config, terms)"
+    "), search_result AS ("
+    "    SELECT id AS article_id,"
+    "           ts_rank_cd('{0.1, 0.2, 0.4, 1.0}', tsvector, query, 0)"
+    "               AS rank,"
+    "           ts_headline(current_html, query) AS headline"
+    "      FROM wiki.article, the_query"
+    "     WHERE tsvector @@ query"
+    ") "
+    "SELECT search_result.article_id, title, namespace, rank, headline,"
+    "       COUNT(*) OVER () AS __count"
+    "  FROM search_result"
+    "  LEFT JOIN wiki.article_title"
+    "         ON search_result.article_id = article_title.article_id"
+    "        AND is_main_title"
+    " WHERE (%s::TEXT IS NULL"
+    "        OR %s::TEXT IN (SELECT namespace FROM wiki.article_title AS t"
+    "                         WHERE t.article_id = search_result.article_id))"
+    "   AND search_result.article_id <> ALL(%s::INTEGER[])"
+    " ORDER BY rank DESC"
+    " LIMIT %s")
+
+def full_text_search(query, namespace=None, exclude_ids=(), limit=None,
+                     lang=None):
     if lang is None:
         configs = [ lang.tsearch_configuration
                     for lang in get_languages().values() ]
@@ -107,54 +148,43 @@ def full_text_search(query, *clauses, lang=None):
     else:
         configs = [ lang.tsearch_configuration, ]
 
-    cc = db.cursor()
-    commands = []
-    params = []
-
-    for config in set(configs):
-        commands.append(f"websearch_to_tsquery('{config}', %(query)s)")
-
-    command = create_query_view.format("||".join(commands))
-    cc.execute(command, { "query": query, })
+    configs = sorted(set(configs))
+    return run_query(configs, [ query, ] * len(configs),
+                     namespace, exclude_ids, limit)
 
-    return run_query(cc, *clauses)
 
-
-def title_search(article_id, *clauses):
+def title_search(article_id, exclude_ids=(), limit=None):
     titles = model.ArticleTitle.select(
         sql.where("article_id = %i" % article_id))
 
-    parts = []
-    params = []
+    configs, queries = [], []
     for title in titles:
-        parts.append('websearch_to_tsquery(%s, %s)')
-        params.append(title.language_object.tsearch_configuration)
-        params.append('"' + title.title.replace('"', ' ') + '"')
-
-    cc = db.cursor()
-    command = create_query_view.format(" || ".join(parts))
-    cc.execute(command, params)
-
-    return run_query(cc, *clauses)
-
-def run_query(cc, *clauses):
-    cc.execute(create_result_view)
-
-    db.execute(sql.select(
-        ("search_result.article_id", "title", "namespace", "rank", "headline",),
-        ("search_result",),
-        sql.left_join("article_title",
-                      "search_result.article_id = article_title.article_id"
-                      "      AND is_main_title"),
-        sql.orderby("rank DESC"),
-        *clauses), cc=cc)
-
-    return [ model.FulltextEntry(cc.description, tpl)
-             for tpl in cc.fetchall() ]
+        configs.append(title.language_object.tsearch_configuration)
+        queries.append('"' + title.title.replace('"', ' ') + '"')
+
+    return run_query(configs, queries, namespace=None,
+                     exclude_ids=exclude_ids, limit=limit)
+
+def run_query(configs, queries, namespace=None, exclude_ids=(), limit=None):
+    """
+    Return FulltextEntry objects for the articles matching any of the
+    websearch_to_tsquery()s made from “configs” and “queries”, best
+    match first, optionally in “namespace” and without the articles in
+    “exclude_ids”. The result’s count() will return the number of
+    matches regardless of “limit”.
+    """
+    cursor = search_statement.execute( (configs, queries,
+                                        namespace, namespace,
+                                        list(exclude_ids), limit, ) )
+    result = db.Result(cursor, model.FulltextEntry, count_column=True)
+    if result._count is None:
+        result._count = 0
+    return result
 
 
 @bp.route("/")
 @bp.route("/<path:article_title>")
+@db.read_only
 @role_required("Reader")
 def article_view(article_title=None):
     t = time.time()
@@ -178,31 +208,32 @@ def article_view(article_title=None):
         # No article found with that title. Present a search result only.
 
         title = markup.Title.parse(article_title)
-        if title.namespace:
-            query_namespace = title.namespace
-            #where = sql.where("namespace = ",
-            #                  sql.string_literal(query_namespace))
-            where = sql.where(
-                sql.string_literal(query_namespace),
-                " IN (SELECT namespace FROM article_title "
-                "      WHERE article_title.article_id = "
-                "search_result.article_id)")
+        query_namespace = title.namespace or ""
 
-        else:
-            where = None
-            query_namespace = ""
+        try:
+            with db.expensive_query("article_view"):
+                search_result = full_text_search(
+                    article_title, namespace=title.namespace or None)
+        except db.QueryTimeout:
+            search_result = None
 
-        search_result = full_text_search(article_title, where)
         if result:
             regular_result = model.Article.select_by_primary_key(result[0])
         else:
             regular_result = None
 
-        return template(article=None,
-                        query=article_title,
-                        query_namespace=query_namespace,
-                        search_result=search_result,
-                        regular_result=regular_result)
+        response = make_response(
+            template(article=None,
+                     query=article_title,
+                     query_namespace=query_namespace,
+                     search_result=search_result,
+                     regular_result=regular_result))
+
+        if search_result is None:
+            response.status_code = 503
+            response.headers["Retry-After"] = "10"
+
+        return response
     else:
         article_id, = result
         included_articles = model.IncludedArticle.query_recursively_for(
@@ -236,22 +267,35 @@ def article_view(article_title=None):
                                                                ia.article_id, )
                                                 for ia in included_articles ])
 
-        file_info_json, = db.query_one(
+        # These three don’t depend on each other.
+        file_info_query = db.ConcurrentQuery(
             "SELECT json_object_agg(article_id, uploads_info)::TEXT"
             "  FROM uploads.upload_info_for_view "
             " WHERE article_id IN (%s)" % article_ids_s)
-        if not file_info_json:
-            file_info_json = "{}"
 
-        link_info, = db.query_one(
+        link_info_query = db.ConcurrentQuery(
             "SELECT json_object_agg(target, full_title)::text "
-            "  FROM article_link_resolved "
+            "  FROM wiki.article_link_resolved "
             " WHERE article_id IN (%s)" % article_ids_s)
 
-        linking_here = list(model.ResolvedArticleTeaser.select(
-            sql.where("resolved_full_title =",
-                      sql.string_literal(main_article.full_title)),
-            sql.orderby("main_title")))
+        linking_here_query = db.ConcurrentQuery(
+            model.ResolvedArticleTeaser.select_query(
+                sql.where("resolved_full_title =",
+                          sql.string_literal(main_article.full_title)),
+                sql.orderby("main_title")),
+            dbobject_class=model.ResolvedArticleTeaser)
+
+        db.run_concurrently(file_info_query,
+                            link_info_query,
+                            linking_here_query)
+
+        file_info_json, = file_info_query.one()
+        if not file_info_json:
+            file_info_json = "{}"
+
+        link_info, = link_info_query.one()
+
+        linking_here = linking_here_query.result
 
         if len(linking_here) == 0:
             where = None
@@ -272,6 +316,7 @@ def article_view(article_title=None):
 
 ids_re = re.compile(r"(\d+,?)+")
 @bp.route("/article_fulltext_search")
+@db.read_only
 @role_required("Reader")
 @gets_parameters_from_request
 def article_fulltext_search(article_id:int, linking_here):
@@ -281,10 +326,19 @@ def article_fulltext_search(article_id:int, linking_here):
     if linking_here != "":
         ignore_ids += [ int(id) for id in linking_here.split(",") ]
 
-    where = sql.where("search_result.article_id NOT IN (%s)" % (
-        ",".join([str(i) for i in ignore_ids]),))
-
-    result = title_search(article_id, where, sql.limit(100))
-    count = db.count("search_result", where)
-
-    return template(search_result=result, full_text_count=count)
+    try:
+        with db.expensive_query("article_fulltext_search"):
+            result = title_search(article_id, exclude_ids=ignore_ids,
+                                  limit=100)
+    except db.QueryTimeout:
+        response = make_response(template(search_result=None,
+                                          full_text_count=None), 503)
+        response.headers["Retry-After"] = "10"
+        return response
+
+    return template(search_result=result, full_text_count=result.count())
+
+@bp.app_errorhandler(db.ClientDisconnected)
+def client_disconnected(exc):
+    # Nobody is listening. 499 is what nginx logs for this.
+    return "", 499
@@ -0,0 +1,50 @@
+import sys, pathlib
+
+import pytest
+import psycopg2.extensions
+
+# Run the tests against this checkout of t4wiki.
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+class FakeCursor(object):
+    """
+    Record the commands executed and return “results”, one list of rows
+    per call to fetchall(). mogrify() quotes like psycopg2 does, without
+    a connection.
+    """
+    def __init__(self, results=()):
+        self.executed = []
+        self.results = list(results)
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+    def execute(self, command, params=None):
+        self.executed.append( (command, params,) )
+
+    def fetchall(self):
+        if self.results:
+            return self.results.pop(0)
+        else:
+            return []
+
+    def mogrify(self, command, params):
+        return command.encode("utf-8") % tuple(
+            psycopg2.extensions.adapt(param).getquoted()
+            for param in params)
+
+@pytest.fixture
+def fake_cursor(monkeypatch):
+    """
+    Have db.cursor() return a FakeCursor, so sql_literal() and friends
+    work without a database.
+    """
+    from t4wiki import db
+
+    cc = FakeCursor()
+    monkeypatch.setattr(db, "cursor", lambda name=None: cc)
+    return cc
@@ -0,0 +1,73 @@
+"""
+These tests need a t4wiki database. Set T4WIKI_TEST_DSN to a libpq
+connection string to run them.
+"""
+
+import os
+
+import pytest
+import flask
+
+from t4 import sql
+
+from t4wiki import db, model
+
+@pytest.fixture
+def app():
+    dsn = os.getenv("T4WIKI_TEST_DSN")
+    if not dsn:
+        pytest.skip("T4WIKI_TEST_DSN not set.")
+
+    app = flask.Flask(__name__)
+    # Connections see nothing but public unless a relation is schema
+    # qualified, like those borrowed from the pool by run_concurrently().
+    app.config.update(DATASOURCE={ "dsn": dsn, },
+                      DBPOOL_SEARCH_PATH="public",
+                      DBPOOL_MINCONN=0,
+                      DBPOOL_MAXCONN=4)
+    app.debug_sql = False
+    app.profile_sql = False
+    db.init_app(app)
+
+    yield app
+
+    app.dbpool.closeall()
+
+def test_article_view_queries(app):
+    with app.test_request_context():
+        link_info_query = db.ConcurrentQuery(
+            "SELECT json_object_agg(target, full_title)::text "
+            "  FROM wiki.article_link_resolved "
+            " WHERE article_id IN (0)")
+
+        link_query = db.ConcurrentQuery(
+            model.ResolvedArticleLink.select_query(sql.limit(1)),
+            dbobject_class=model.ResolvedArticleLink)
+
+        linking_here_query = db.ConcurrentQuery(
+            model.ResolvedArticleTeaser.select_query(
+                sql.orderby("main_title"), sql.limit(1)),
+            dbobject_class=model.ResolvedArticleTeaser)
+
+        link_info, link, linking_here = db.run_concurrently(
+            link_info_query, link_query, linking_here_query)
+
+        assert link_info == [ ( None, ), ]
+        assert len(link) <= 1
+        assert len(linking_here) <= 1
+
+        # Both others ran on connections of their own.
+        assert app.dbpool.statistics()["connects"] == 3
+
+def test_fresh_pooled_connection(app):
+    query = db.ConcurrentQuery(
+        model.ResolvedArticleTeaser.select_query(sql.limit(1)),
+        dbobject_class=model.ResolvedArticleTeaser)
+
+    dbconn = app.dbpool.getconn()
+    try:
+        query.run(db.wrap_cursor(dbconn.cursor(), False, None))
+    finally:
+        app.dbpool.putconn(dbconn)
+
+    assert len(query.result) <= 1
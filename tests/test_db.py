@@ -0,0 +1,132 @@
+import collections
+
+import pytest
+
+from t4wiki import db
+
+Column = collections.namedtuple("Column", ( "name", ))
+
+class Thing(db.dbobject):
+    @property
+    def ext(self):
+        return self._ext
+
+    @ext.setter
+    def ext(self, ext):
+        self._ext = ext.lower()
+
+    @property
+    def title(self):
+        return "read-only"
+
+def test_row_class():
+    description = [ Column("id"), Column("ext"), Column("title"), ]
+    thing = Thing(description, ( 1, ".JPG", "Photo", ))
+
+    assert isinstance(thing, Thing)
+    assert thing.id == 1
+    assert thing.ext == ".jpg"
+    assert thing.title == "read-only"
+    assert thing._title == "Photo"
+
+    # Assigned values override the row’s.
+    thing.id = 2
+    assert thing.id == 2
+    assert thing.__dict__["id"] == 2
+
+    # One row class per set of columns.
+    other = Thing(description, ( 3, ".png", "Other", ))
+    assert type(other) is type(thing)
+    assert type(Thing([ Column("id"), ], ( 4, ))) is not type(thing)
+
+def test_as_dict():
+    thing = Thing([ Column("id"), Column("name"), ], ( 1, "a", ))
+    thing.extra = True
+    assert thing.as_dict() == { "id": 1, "name": "a", "extra": True, }
+
+def test_statement_postgres_command():
+    statement = db.Statement(
+        "test_postgres_command",
+        "SELECT * FROM wiki.article_title "
+        " WHERE title = %s AND namespace LIKE 'a%%' AND article_id = %s")
+
+    assert statement.postgres_command == (
+        "SELECT * FROM wiki.article_title "
+        " WHERE title = $1 AND namespace LIKE 'a%' AND article_id = $2")
+
+def test_statement_names_are_unique():
+    db.Statement("test_unique_name", "SELECT 1")
+    with pytest.raises(KeyError):
+        db.Statement("test_unique_name", "SELECT 2")
+
+def test_insert_many(fake_cursor):
+    fake_cursor.results = [ [ (1,), (2,), ], [ (3,), ], ]
+
+    rows = [ { "article_id": a, "filename": "f%i" % a, } for a in range(3) ]
+    ids = db.insert_many("uploads.upload", rows, returning="id",
+                         on_conflict="(article_id, filename) DO NOTHING",
+                         pagesize=2)
+
+    assert ids == [ 1, 2, 3, ]
+    assert len(fake_cursor.executed) == 2
+    for command, params in fake_cursor.executed:
+        assert command.startswith("INSERT INTO uploads.upload")
+        assert command.endswith(" ON CONFLICT (article_id, filename) "
+                                "DO NOTHING RETURNING id")
+
+def test_insert_many_returning_tuples(fake_cursor):
+    fake_cursor.results = [ [ (1, "a",), ], ]
+    ret = db.insert_many("t", [ { "name": "a", }, ],
+                         returning=( "id", "name", ))
+    assert ret == [ (1, "a",), ]
+    assert fake_cursor.executed[0][0].endswith(" RETURNING id, name")
+
+def test_insert_many_without_returning(fake_cursor):
+    assert db.insert_many("t", [ { "name": "a", }, ]) is None
+    assert " RETURNING " not in fake_cursor.executed[0][0]
+    assert db.insert_many("t", []) == []
+
+def test_insert_many_needs_identical_keys(fake_cursor):
+    with pytest.raises(db.DbUsageException):
+        db.insert_many("t", [ { "a": 1, }, { "b": 2, }, ])
+
+    with pytest.raises(db.DbUsageException):
+        db.insert_many("t", [ { "a": 1, }, { "a": 2, "b": 2, }, ])
+
+    assert fake_cursor.executed == []
+
+def test_sql_literal(fake_cursor):
+    assert db.sql_literal(3) == "3"
+    assert db.sql_literal(None) == "NULL"
+    assert db.sql_literal("O'Neil") == "'O''Neil'"
+
+    # The literal goes into a command that is formatted again.
+    assert db.sql_literal("100%") == "'100%%'"
+    assert db.sql_literal("%s") == "'%%s'"
+
+def test_copy_text():
+    assert db.copy_text(None) == "\\N"
+    assert db.copy_text(True) == "t"
+    assert db.copy_text(False) == "f"
+    assert db.copy_text(42) == "42"
+    assert db.copy_text("a\tb\nc\rd\\e") == "a\\tb\\nc\\rd\\\\e"
+
+def test_copy_reader():
+    reader = db.CopyReader([ b"abc", b"", b"defg", b"h", ])
+    assert reader.read(2) == b"ab"
+    assert reader.read(4) == b"cdef"
+    assert reader.read() == b"gh"
+    assert reader.read(10) == b""
+
+def test_select_with_count(fake_cursor):
+    fake_cursor.description = [ Column("id"), Column("__total_count"), ]
+    fake_cursor.results = [ [ ( 1, 5, ), ( 2, 5, ), ], ]
+
+    result = Thing.select_with_count(db.sql.limit(2))
+
+    assert [ thing.id for thing in result ] == [ 1, 2, ]
+    assert not hasattr(result[0], "__total_count")
+    assert result.count() == 5
+
+    command, params = fake_cursor.executed[0]
+    assert "COUNT(*) OVER () AS __total_count" in command
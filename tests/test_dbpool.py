@@ -0,0 +1,22 @@
+from t4wiki.dbpool import ConnectionPool
+
+def test_search_path():
+    pool = ConnectionPool.from_config({ "DATASOURCE": { "dbname": "wiki", },
+                                        "DBPOOL_MINCONN": 0, })
+    assert pool.connect_parameters() == {
+        "dbname": "wiki",
+        "options": "-c search_path=wiki,uploads,public", }
+
+def test_search_path_with_options():
+    pool = ConnectionPool({ "dbname": "wiki",
+                            "options": "-c statement_timeout=5000", },
+                          minconn=0, search_path="wiki, public")
+    assert pool.connect_parameters()["options"] == \
+        "-c statement_timeout=5000 -c search_path=wiki,public"
+
+    # The datasource itself stays untouched.
+    assert pool.datasource["options"] == "-c statement_timeout=5000"
+
+def test_no_search_path():
+    pool = ConnectionPool({ "dbname": "wiki", }, minconn=0)
+    assert pool.connect_parameters() == { "dbname": "wiki", }
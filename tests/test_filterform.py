@@ -0,0 +1,140 @@
+import datetime
+
+from t4wiki.db import rollup_sql
+from t4wiki.filterform import (parse_orderby, OrderByOption, KeysetPager,
+                               AndreasPagerOption)
+
+class OrderByHandler(object):
+    param_name = "orderby"
+
+    def __init__(self, active):
+        self.active = active
+
+class Row(object):
+    __primary_key_column__ = "id"
+
+def pager_for(expression, nullable=()):
+    return KeysetPager(30, OrderByHandler(OrderByOption(expression, "Test")),
+                       Row, None, nullable=nullable)
+
+def sql_string(part):
+    command, params = rollup_sql(part)
+    return command
+
+def test_parse_orderby():
+    assert parse_orderby("mtime DESC") == [ ( "mtime", True, ), ]
+    assert parse_orderby("main_title") == [ ( "main_title", False, ), ]
+    assert parse_orderby("wordcount asc, article.ctime DESC") == [
+        ( "wordcount", False, ), ( "article.ctime", True, ), ]
+
+    assert parse_orderby("lower(main_title)") is None
+    assert parse_orderby("mtime DESC NULLS LAST") is None
+    assert parse_orderby("mtime DESC,") is None
+
+def test_keyset_columns():
+    assert pager_for("mtime DESC").columns == [
+        ( "mtime", True, ), ( "id", True, ), ]
+    assert pager_for("id ASC").columns == [ ( "id", False, ), ]
+    assert pager_for("wordcount ASC, ctime DESC").columns == [
+        ( "wordcount", False, ), ( "ctime", True, ), ( "id", True, ), ]
+
+def test_keyset_encode_decode():
+    pager = pager_for("ctime DESC")
+
+    s = pager.encode_key([ datetime.datetime(2024, 5, 1, 12, 30), 17, ])
+    assert pager.decode_key(s) == [ "2024-05-01T12:30:00", 17, ]
+
+    assert pager.decode_key('[ "a", 1.5 ]') == [ "a", 1.5, ]
+    assert pager.decode_key('[ null, 1 ]') == [ None, 1, ]
+
+def test_keyset_decode_rejects_garbage():
+    pager = pager_for("ctime DESC")
+
+    assert pager.decode_key("not json") is None
+    assert pager.decode_key('{ "a": 1 }') is None
+    assert pager.decode_key('[ 1 ]') is None
+    assert pager.decode_key('[ 1, 2, 3 ]') is None
+    assert pager.decode_key('[ { "a": 1 }, 2 ]') is None
+    assert pager.decode_key('[ [ 1 ], 2 ]') is None
+    assert pager.decode_key('[ true, 2 ]') is None
+
+def test_keyset_where_same_direction(fake_cursor):
+    pager = pager_for("mtime DESC")
+
+    assert sql_string(pager.key_where([ "2024-05-01", 17, ], True)) == \
+        "WHERE (mtime, id) < ('2024-05-01', 17)"
+    assert sql_string(pager.key_where([ "2024-05-01", 17, ], False)) == \
+        "WHERE (mtime, id) > ('2024-05-01', 17)"
+
+def test_keyset_where_mixed_directions(fake_cursor):
+    pager = pager_for("wordcount ASC, ctime DESC")
+
+    assert sql_string(pager.key_where([ 100, "2024", 17, ], True)) == (
+        "WHERE wordcount >= 100 AND ("
+        "(wordcount > 100) OR "
+        "(wordcount = 100 AND ctime < '2024') OR "
+        "(wordcount = 100 AND ctime = '2024' AND id < 17))")
+
+    assert sql_string(pager.key_where([ 100, "2024", 17, ], False)) == (
+        "WHERE wordcount <= 100 AND ("
+        "(wordcount < 100) OR "
+        "(wordcount = 100 AND ctime > '2024') OR "
+        "(wordcount = 100 AND ctime = '2024' AND id > 17))")
+
+def test_keyset_orderby():
+    pager = pager_for("wordcount ASC, ctime DESC")
+
+    assert sql_string(pager.orderby(True)) == \
+        "ORDER BY wordcount ASC, ctime DESC, id DESC"
+    assert sql_string(pager.orderby(False)) == \
+        "ORDER BY wordcount DESC, ctime ASC, id ASC"
+
+def test_keyset_nullable_orderby(fake_cursor):
+    pager = pager_for("main_title", nullable=( "main_title", ))
+
+    assert sql_string(pager.orderby(True)) == \
+        "ORDER BY main_title ASC NULLS LAST, id ASC"
+    assert sql_string(pager.orderby(False)) == \
+        "ORDER BY main_title DESC NULLS FIRST, id DESC"
+
+    # Only the nullable columns get a NULLS clause, so the others still
+    # match their indexes.
+    pager = pager_for("mtime DESC", nullable=( "main_title", ))
+    assert sql_string(pager.orderby(True)) == "ORDER BY mtime DESC, id DESC"
+    assert sql_string(pager.key_where([ "2024", 17, ], True)) == \
+        "WHERE (mtime, id) < ('2024', 17)"
+
+def test_keyset_where_nullable(fake_cursor):
+    pager = pager_for("main_title", nullable=( "main_title", ))
+
+    # Going forward, the NULLs come after any title.
+    assert sql_string(pager.key_where([ "Abraham", 17, ], True)) == (
+        "WHERE (((main_title > 'Abraham' OR main_title IS NULL)) OR "
+        "(main_title = 'Abraham' AND id > 17))")
+    assert sql_string(pager.key_where([ "Abraham", 17, ], False)) == (
+        "WHERE ((main_title < 'Abraham') OR "
+        "(main_title = 'Abraham' AND id < 17))")
+
+def test_keyset_where_null_key(fake_cursor):
+    pager = pager_for("main_title", nullable=( "main_title", ))
+
+    # Among the NULLs, the id decides. The titled rows are before them.
+    assert sql_string(pager.key_where([ None, 17, ], True)) == \
+        "WHERE ((main_title IS NULL AND id > 17))"
+    assert sql_string(pager.key_where([ None, 17, ], False)) == (
+        "WHERE ((main_title IS NOT NULL) OR "
+        "(main_title IS NULL AND id < 17))")
+
+def test_keyset_where_null_key_mixed(fake_cursor):
+    pager = pager_for("wordcount DESC, main_title ASC",
+                      nullable=( "main_title", ))
+
+    assert sql_string(pager.key_where([ 100, None, 17, ], True)) == (
+        "WHERE wordcount <= 100 AND ((wordcount < 100) OR "
+        "(wordcount = 100 AND main_title IS NULL AND id > 17))")
+
+def test_pager_option_label():
+    option = AndreasPagerOption("main_title", "Title",
+                                pager_button_label_f=lambda a: a[:3])
+    assert option.order_columns == [ ( "main_title", False, ), ]
+    assert option.pager_button_label_f("Abraham") == "Abr"
@@ -0,0 +1,113 @@
+import os, time
+
+from t4wiki.preview_gc import (SpaceCounter, collect_preview_garbage,
+                               preview_dir_name, preview_dir_re)
+
+class FakeConnection(object):
+    """
+    Answer _current_preview_dirs()’s query with “uploads”, a list of
+    ( id, article_id, slug, preview_version, ) tuples.
+    """
+    def __init__(self, uploads):
+        self.uploads = uploads
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+    def execute(self, command, params):
+        self.ids = set(params[0])
+
+    def fetchall(self):
+        return [ upload for upload in self.uploads if upload[0] in self.ids ]
+
+    def rollback(self):
+        pass
+
+def make_dir(path, days_ago, *filenames):
+    path.mkdir()
+    for filename in filenames:
+        (path / filename).write_bytes(b"x" * 5000)
+
+    mtime = time.time() - days_ago * 86400
+    for p in [ path, ] + list(path.iterdir()):
+        os.utime(p, ( mtime, mtime, ))
+    return path
+
+def test_preview_dir_name():
+    # Version 0 are the previews made before they were versioned.
+    assert preview_dir_name(1, 5, "pic", 0) == "1_5_pic"
+    assert preview_dir_name(1, 5, "pic", None) == "1_5_pic"
+    assert preview_dir_name(1, 5, "pic", 2) == "1_5_pic_v2"
+    assert preview_dir_re.match("1_5_pic_v2").group(2) == "5"
+
+def test_space_counter(tmp_path):
+    a = tmp_path / "a"
+    a.write_bytes(b"x" * 10000)
+    b = tmp_path / "b"
+    os.link(a, b)
+    c = tmp_path / "c"
+    c.write_bytes(b"x" * 10000)
+
+    counter = SpaceCounter()
+    counter.add(a)
+    # “b” still links to the data.
+    assert counter.files == 1
+    assert counter.bytes == 0
+
+    counter.add(b)
+    assert counter.files == 2
+    assert counter.bytes == a.stat().st_blocks * 512
+
+    counter = SpaceCounter()
+    counter.add_tree(tmp_path)
+    assert counter.files == 3
+    assert counter.bytes == (a.stat().st_blocks + c.stat().st_blocks) * 512
+
+def test_collect_preview_garbage(tmp_path):
+    current = make_dir(tmp_path / "1_5_pic_v2", 0, "preview1.jpg")
+    superseded = make_dir(tmp_path / "1_5_pic", 100, "preview1.jpg")
+    deleted = make_dir(tmp_path / "1_6_gone", 2, "preview1.jpg")
+    deleted_recently = make_dir(tmp_path / "1_7_gone", 0, "preview1.jpg")
+    temporary = make_dir(tmp_path / ".render-1", 2, "preview1.jpg")
+    stray = make_dir(tmp_path / "2_8_doc", 2, "preview1.jpg", "grey.jpg")
+
+    dbconn = FakeConnection([ ( 5, 1, "pic", 2, ), ( 8, 2, "doc", 0, ), ])
+    report = collect_preview_garbage(dbconn, tmp_path, dry_run=True)
+    assert report.dirs == 2
+    assert report.files == 3
+    assert superseded.exists() and deleted.exists()
+
+    report = collect_preview_garbage(dbconn, tmp_path)
+    assert report.dirs == 2
+    assert report.files == 3
+
+    assert current.exists()
+    assert deleted_recently.exists()
+    assert not deleted.exists()
+    assert not temporary.exists()
+    assert (stray / "preview1.jpg").exists()
+    assert not (stray / "grey.jpg").exists()
+
+    # The superseded version was rendered long ago, but its successor
+    # has not been around for min_age yet.
+    assert superseded.exists()
+
+    mtime = time.time() - 2 * 86400
+    os.utime(current, ( mtime, mtime, ))
+    report = collect_preview_garbage(dbconn, tmp_path)
+    assert report.dirs == 1
+    assert not superseded.exists()
+    assert current.exists()
+
+def test_superseded_without_successor(tmp_path):
+    # The current version has not been rendered yet.
+    old = make_dir(tmp_path / "1_5_pic", 100, "preview1.jpg")
+    dbconn = FakeConnection([ ( 5, 1, "pic", 2, ), ])
+    assert collect_preview_garbage(dbconn, tmp_path).dirs == 0
+    assert old.exists()
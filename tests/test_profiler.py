@@ -0,0 +1,17 @@
+from t4wiki.profiler import normalize_sql
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT *\n  FROM wiki.article\n WHERE id = 17") \
+        == "SELECT * FROM wiki.article WHERE id = ?"
+
+    assert normalize_sql(b"SELECT 'it''s', 1.5 WHERE x = 'a b'") \
+        == "SELECT ?, ? WHERE x = ?"
+
+def test_normalize_sql_value_lists():
+    assert normalize_sql("SELECT * FROM t WHERE id IN (1, 2, 3)") == \
+        normalize_sql("SELECT * FROM t WHERE id IN (4,5)") == \
+        "SELECT * FROM t WHERE id IN (…)"
+
+def test_normalize_sql_keeps_identifiers():
+    assert normalize_sql("SELECT preview2 FROM t2 LIMIT 30") \
+        == "SELECT preview2 FROM t2 LIMIT ?"
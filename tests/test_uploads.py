@@ -0,0 +1,106 @@
+import pytest
+
+from t4wiki import articles_blueprint
+from t4wiki.articles_blueprint import upload_field_value, modify_uploads_in_db
+from t4wiki.exceptions import FilenameUnavailable
+
+class FakeExecute(object):
+    """
+    Stand-in for db.execute(). The SELECT of an article’s filenames
+    returns “filenames”, a list of ( id, filename, ) tuples.
+    """
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.executed = []
+
+    def __call__(self, command, parameters=()):
+        self.executed.append( (command, parameters,) )
+        return self
+
+    def fetchall(self):
+        return self.filenames
+
+@pytest.fixture
+def execute(monkeypatch):
+    ret = FakeExecute([ ( 1, "a.jpg", ), ( 2, "b.jpg", ), ( 3, "c.jpg", ), ])
+    monkeypatch.setattr(articles_blueprint, "execute", ret)
+    return ret
+
+def test_upload_field_value():
+    assert upload_field_value("sortrank", "2.5") == 2.5
+    assert upload_field_value("gallery", True) is True
+    assert upload_field_value("gallery", "on") is True
+    assert upload_field_value("is_download", False) is False
+    assert upload_field_value("is_download", "off") is False
+    assert upload_field_value("title", 17) == "17"
+    assert upload_field_value("filename", "../../etc/passwd") == "passwd"
+
+    with pytest.raises(ValueError):
+        upload_field_value("article_id", 2)
+
+    with pytest.raises(ValueError):
+        upload_field_value("sortrank", "first")
+
+def test_modify_uploads_in_one_update(execute):
+    modify_uploads_in_db(1, [ [ 1, "title", "One", ],
+                              [ 1, "sortrank", "3", ],
+                              [ 2, "gallery", True, ], ])
+
+    assert len(execute.executed) == 1
+    command, ( changes, article_id, ) = execute.executed[0]
+    assert command.startswith("UPDATE uploads.upload")
+    assert article_id == 1
+    assert changes == ('[{"id": 1, "title": "One", "sortrank": 3.0}, '
+                       '{"id": 2, "gallery": true}]')
+
+def test_rename(execute):
+    modify_uploads_in_db(1, [ [ 1, "filename", "d.jpg", ],
+                              [ 2, "filename", "b.jpg", ], ])
+    assert len(execute.executed) == 2
+
+@pytest.mark.parametrize("changes", [
+    # Another upload has that name.
+    [ [ 1, "filename", "b.jpg", ], ],
+    # Swapping names would violate UNIQUE(article_id, filename) midway.
+    [ [ 1, "filename", "b.jpg", ], [ 2, "filename", "a.jpg", ], ],
+    # Two uploads renamed to the same name.
+    [ [ 1, "filename", "d.jpg", ], [ 2, "filename", "d.jpg", ], ], ])
+def test_rename_conflicts(execute, changes):
+    with pytest.raises(FilenameUnavailable):
+        modify_uploads_in_db(1, changes)
+
+    # Only the SELECT of the filenames, no UPDATE.
+    assert len(execute.executed) == 1
+
+@pytest.mark.parametrize("changes", [
+    [ [ 1, "title", ], ],
+    [ 17, ],
+    [ [ None, "title", "x", ], ],
+    [ [ 1, "article_id", 2, ], ],
+    "abc", ])
+def test_malformed_changes(execute, changes):
+    with pytest.raises(( TypeError, ValueError, )):
+        modify_uploads_in_db(1, changes)
+
+    assert execute.executed == []
+
+def test_order(execute):
+    modify_uploads_in_db(1, [ [ 1, "title", "One", ], ], order=[ 3, "1", 2, ])
+
+    assert len(execute.executed) == 2
+    command, ( order, article_id, ) = execute.executed[1]
+    assert "unnest(%s::INTEGER[]) WITH ORDINALITY" in command
+    assert order == [ 3, 1, 2, ]
+    assert article_id == 1
+
+def test_order_only(execute):
+    modify_uploads_in_db(1, [], order=[ 2, 1, ])
+    assert len(execute.executed) == 1
+    assert execute.executed[0][1] == ( [ 2, 1, ], 1, )
+
+@pytest.mark.parametrize("order", [ "123", 17, [ 1, "first", ], [ 1, 2, 1, ], ])
+def test_malformed_order(execute, order):
+    with pytest.raises(( TypeError, ValueError, )):
+        modify_uploads_in_db(1, [ [ 1, "title", "One", ], ], order=order)
+
+    assert execute.executed == []